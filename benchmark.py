@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+#
+# Headless render benchmark for the LED effects. Runs every routine in playlists.py and
+# testplaylists.py against a synthetic clock and synthetic headset data, so no OPC server
+# or headset is needed, and reports per-layer and per-routine render times.
+#
+# Usage: ./benchmark.py [-n frames] [-o results.json] [--routine name] [--dtype float32]
+#
+# Results are written as JSON (to stdout by default) so runs can be compared; a readable
+# summary goes to stderr. The output stages (gamma correction and conversion to OPC bytes)
+# are timed separately.
+
+from __future__ import print_function
+import argparse
+import ctypes
+import json
+import math
+import os
+import platform
+import re
+import random
+import sys
+import timeit
+import numpy
+from led.model import Model
+from led.effects.base import EffectParameters, GammaLayer
+from led.controller import frameDtype, frameDtypes, FrameBuffer, LUTEncoder, DitheringEncoder
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class TracemallocTracker(object):
+    """Peak Python memory allocated between start() and stop(), with tracemalloc."""
+
+    name = 'tracemalloc'
+
+    def start(self):
+        tracemalloc.start()
+
+    def stop(self):
+        """Returns (bytes, number of allocations or None)."""
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak, None
+
+
+class NumpyAllocationTracker(object):
+    """Counts numpy array data allocated between start() and stop(), for Pythons without
+       tracemalloc. This uses numpy's PyDataMem_SetEventHook, which sees every malloc and
+       realloc of array data, temporaries included, but not small Python objects.
+
+       The hook is only reachable through numpy's C API table, so its slot is looked up in
+       numpy's own header. Raises RuntimeError if that isn't possible.
+       """
+
+    name = 'numpy'
+
+    HookFunc = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t,
+                                ctypes.c_void_p)
+
+    def __init__(self):
+        header = os.path.join(numpy.get_include(), 'numpy', '__multiarray_api.h')
+        try:
+            with open(header) as f:
+                match = re.search(r'#define PyDataMem_SetEventHook\b[^\[]*PyArray_API\[(\d+)\]',
+                                  f.read())
+        except IOError:
+            match = None
+        if match is None:
+            raise RuntimeError("Can't find PyDataMem_SetEventHook in %s" % header)
+
+        from numpy.core import multiarray
+        api = multiarray._ARRAY_API
+        if type(api).__name__ == 'PyCapsule':
+            getPointer = ctypes.pythonapi.PyCapsule_GetPointer
+            getPointer.argtypes = [ctypes.py_object, ctypes.c_char_p]
+            getPointer.restype = ctypes.c_void_p
+            table = getPointer(api, None)
+        else:
+            getPointer = ctypes.pythonapi.PyCObject_AsVoidPtr
+            getPointer.argtypes = [ctypes.py_object]
+            getPointer.restype = ctypes.c_void_p
+            table = getPointer(api)
+
+        slot = ctypes.cast(table, ctypes.POINTER(ctypes.c_void_p))[int(match.group(1))]
+        self._setHook = ctypes.CFUNCTYPE(ctypes.c_void_p, self.HookFunc, ctypes.c_void_p,
+            ctypes.POINTER(ctypes.c_void_p))(slot)
+        self._hook = self.HookFunc(self._event)
+        self.bytes = self.count = 0
+
+    def _event(self, old, new, size, userData):
+        # Frees have no new pointer; reallocs have both
+        if new and size:
+            self.bytes += size
+            self.count += 1
+
+    def start(self):
+        self.bytes = self.count = 0
+        self._setHook(self._hook, None, ctypes.byref(ctypes.c_void_p()))
+
+    def stop(self):
+        """Returns (bytes, number of allocations)."""
+        self._setHook(self.HookFunc(), None, ctypes.byref(ctypes.c_void_p()))
+        return self.bytes, self.count
+
+
+def allocationTracker():
+    """The best way we have to measure allocations here, or None, with a warning."""
+    if tracemalloc:
+        return TracemallocTracker()
+    try:
+        return NumpyAllocationTracker()
+    except (RuntimeError, AttributeError, ValueError, OSError) as err:
+        sys.stderr.write("WARNING: allocations can't be measured on this Python "
+                         "(no tracemalloc, and %s); alloc_bytes will be missing\n" % err)
+        return None
+
+
+class SyntheticEEG(object):
+    """Stands in for threads.HeadsetThread.EEGInfo. Attention and meditation sweep
+       independently through their whole range every few seconds, so a short run exercises
+       responsive layers at both ends.
+       """
+
+    def __init__(self, t):
+        self.attention = 0.5 + 0.5 * math.sin(t * 1.6)
+        self.meditation = 0.5 + 0.5 * math.sin(t * 1.1 + 1.0)
+        self.on = True
+        self.poor_signal = 0
+
+
+def playlistRoutines():
+    """List (name, layers) for every routine in the real and test playlists."""
+    import playlists
+    import testplaylists
+
+    routines = []
+    for module in (playlists, testplaylists):
+        for name in ('headsetOn', 'headsetOff', 'transition'):
+            for i, routine in enumerate(getattr(module, name).routines):
+                routines.append(('%s.%s[%d]' % (module.__name__, name, i), routine))
+    return routines
+
+
+def summarize(samples):
+    """Timing statistics, in milliseconds, for a list of durations in seconds."""
+    ms = numpy.array(samples) * 1000.0
+    return {
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(numpy.percentile(ms, 50)),
+        'p99_ms': float(numpy.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+
+
+def benchmarkRoutine(model, layers, frames, warmup=10, allocFrames=20, frameRate=100.0,
+                     dtype=numpy.float64, tracker=None):
+    """Render one routine (followed by gamma correction, like the Renderer does) for a number
+       of frames and return (routine stats, list of per-layer stats).
+
+       Allocation is measured in separate frames with 'tracker' (see allocationTracker()),
+       so it doesn't distort the timings. With tracemalloc, 'alloc_bytes' is the peak memory
+       allocated while a layer renders one frame. Without it, 'alloc_bytes' is the total
+       numpy array data allocated, and 'alloc_count' the number of allocations.
+       """
+    layers = list(layers) + [GammaLayer(2.2)]
+    params = EffectParameters()
+    params.targetFrameRate = frameRate
+    params.time = 1000.0
+    frame = numpy.zeros((model.numLEDs, 3), dtype)
+    times = [[] for layer in layers]
+    totals = []
+    allocs = [[] for layer in layers]
+    allocCounts = [[] for layer in layers]
+    errors = [None] * len(layers)
+    timer = timeit.default_timer
+
+    def renderFrame(record, measureAlloc=False):
+        params.time += 1.0 / frameRate
+        if params.eeg is None or int(params.time) != int(params.time - 1.0 / frameRate):
+            params.eeg = SyntheticEEG(params.time)
+        frame.fill(0)
+        frameStart = timer()
+        for i, layer in enumerate(layers):
+            if errors[i]:
+                continue
+            if measureAlloc:
+                tracker.start()
+            start = timer()
+            try:
+                layer.render(model, params, frame)
+            except Exception as err:
+                errors[i] = '%s: %s' % (type(err).__name__, err)
+            end = timer()
+            if measureAlloc:
+                allocBytes, allocCount = tracker.stop()
+                allocs[i].append(allocBytes)
+                if allocCount is not None:
+                    allocCounts[i].append(allocCount)
+            if record and not errors[i]:
+                times[i].append(end - start)
+        if record:
+            totals.append(timer() - frameStart)
+
+    for layer in layers:
+        layer.prepare(model)
+    for n in range(warmup):
+        renderFrame(False)
+    for n in range(frames):
+        renderFrame(True)
+    if tracker:
+        for n in range(allocFrames):
+            renderFrame(False, measureAlloc=True)
+
+    layerStats = []
+    for i, layer in enumerate(layers):
+        stats = {'layer': type(layer).__name__, 'index': i}
+        if times[i]:
+            stats.update(summarize(times[i]))
+        if allocs[i]:
+            stats['alloc_bytes'] = int(numpy.mean(allocs[i]))
+        if allocCounts[i]:
+            stats['alloc_count'] = float(numpy.mean(allocCounts[i]))
+        if errors[i]:
+            stats['error'] = errors[i]
+        layerStats.append(stats)
+
+    routineStats = summarize(totals)
+    if tracker:
+        routineStats['alloc_bytes'] = sum(s.get('alloc_bytes', 0) for s in layerStats)
+        if any(allocCounts):
+            routineStats['alloc_count'] = sum(s.get('alloc_count', 0) for s in layerStats)
+    return routineStats, layerStats
+
+
+def allocSummary(stats):
+    """Allocations per frame, for the readable summary."""
+    if 'alloc_bytes' not in stats:
+        return ''
+    if 'alloc_count' in stats:
+        return '  alloc %7d B in %.1f' % (stats['alloc_bytes'], stats['alloc_count'])
+    return '  alloc %7d B' % stats['alloc_bytes']
+
+
+def benchmarkOutput(model, frames, dtype=numpy.float64):
+    """Time each way of getting a rendered frame onto the wire, from 0-1 floats to an
+       encoded OPC message, and return {stage name: stats}. 'plain' is the Renderer's
+       GammaLayer followed by the controller's scale, clip and cast.
+       """
+    # A dim, slowly changing frame, where dithering matters most
+    source = numpy.random.random_sample((model.numLEDs, 3)).astype(dtype) * 0.3
+    drift = numpy.random.random_sample((model.numLEDs, 3)).astype(dtype) * 0.001
+    gamma = GammaLayer(2.2)
+
+    def plain(frameBuffer):
+        gamma.render(model, None, frameBuffer.frame)
+        numpy.multiply(frameBuffer.frame, 255, frameBuffer.frame)
+        frameBuffer.encode()
+
+    stages = [
+        ('plain', FrameBuffer(model.numLEDs, dtype=dtype), plain),
+        ('lut', FrameBuffer(model.numLEDs, dtype=dtype, encoder=LUTEncoder(2.2)),
+         FrameBuffer.encode),
+        ('dither', FrameBuffer(model.numLEDs, dtype=dtype, encoder=DitheringEncoder(2.2)),
+         FrameBuffer.encode),
+    ]
+    timer = timeit.default_timer
+    results = {}
+    for name, frameBuffer, stage in stages:
+        times = []
+        for n in range(frames):
+            numpy.add(source, drift, source)
+            frameBuffer.frame[:] = source
+            start = timer()
+            stage(frameBuffer)
+            times.append(timer() - start)
+        results[name] = summarize(times)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless LED effect render benchmark")
+    parser.add_argument('-n', '--frames', type=int, default=500, help="Frames to time per routine")
+    parser.add_argument('-o', '--output', help="Write JSON results to this file instead of stdout")
+    parser.add_argument('--routine', help="Only run routines whose name contains this string")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed")
+    parser.add_argument('--dtype', default='float64',
+                        help="Frame dtype: %s, or auto" % ', '.join(frameDtypes))
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    numpy.random.seed(args.seed)
+    model = Model('modeling/graph.data.json', 'modeling/manual.remap.json')
+    dtype = frameDtype(args.dtype, model.numLEDs)
+    tracker = allocationTracker()
+
+    results = {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+        'numLEDs': model.numLEDs,
+        'dtype': dtype.name,
+        'frames': args.frames,
+        'alloc_tracking': tracker.name if tracker else None,
+        'routines': [],
+    }
+
+    for name, layers in playlistRoutines():
+        if args.routine and args.routine not in name:
+            continue
+        routineStats, layerStats = benchmarkRoutine(model, layers, args.frames, dtype=dtype,
+                                                   tracker=tracker)
+        routineStats['routine'] = name
+        routineStats['layers'] = layerStats
+        results['routines'].append(routineStats)
+
+        sys.stderr.write("%-36s mean %6.3f  p99 %6.3f  max %6.3f ms%s\n" % (
+            name, routineStats['mean_ms'], routineStats['p99_ms'], routineStats['max_ms'],
+            allocSummary(routineStats)))
+        for stats in layerStats:
+            if 'error' in stats:
+                sys.stderr.write("    %-32s %s\n" % (stats['layer'], stats['error']))
+            else:
+                sys.stderr.write("    %-32s mean %6.3f  p99 %6.3f  max %6.3f ms%s\n" % (
+                    stats['layer'], stats['mean_ms'], stats['p99_ms'], stats['max_ms'],
+                    allocSummary(stats)))
+
+    if not args.routine:
+        results['output'] = benchmarkOutput(model, args.frames, dtype)
+        for name, stats in sorted(results['output'].items()):
+            sys.stderr.write("output stage %-23s mean %6.3f  p99 %6.3f  max %6.3f ms\n" % (
+                name, stats['mean_ms'], stats['p99_ms'], stats['max_ms']))
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
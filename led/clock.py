@@ -0,0 +1,29 @@
+# The clock for measuring intervals: frame deadlines and render times. Unlike time.time(),
+# it doesn't jump when NTP sets the Pi's clock.
+
+import time
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock in the standard library, so ask librt directly.
+    import ctypes
+    import ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        _librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        _clock_gettime = _librt.clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    except (OSError, AttributeError):
+        _clock_gettime = None
+
+    def monotonic():
+        """Seconds on a clock which never jumps, for measuring intervals."""
+        if _clock_gettime is None:
+            return time.time()
+        t = _timespec()
+        _clock_gettime(1, ctypes.byref(t))  # CLOCK_MONOTONIC
+        return t.tv_sec + t.tv_nsec * 1e-9
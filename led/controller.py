@@ -3,13 +3,97 @@
 from model import Model
 from effects.base import EffectParameters
 from renderer import Renderer
+from clock import monotonic
 import os
+import json
+import platform
 import socket
+import threading
 import time
 import sys
 import numpy
 import math
 import struct
+
+
+# Element types the effect layers can render in. Layer math is all floating point, so
+# these are the only sensible choices; which is faster depends on the CPU and NumPy build.
+frameDtypes = ('float64', 'float32')
+
+# Where 'auto' remembers its benchmark result, per machine and NumPy version
+frameDtypeCache = os.path.expanduser('~/.led-frame-dtype.json')
+
+
+def benchmarkFrameDtypes(numLEDs, dtypes=frameDtypes, repeat=5, iterations=20):
+    """Time the operations a typical frame goes through (clear, add a layer, scale, gamma,
+       clip and convert to bytes) in each dtype. Returns {dtype name: best seconds per frame}.
+       """
+    shape = (numLEDs, 3)
+    pixels = numpy.empty(shape, dtype=numpy.uint8)
+    lutX = numpy.linspace(0, 1, 100)
+    lutY = lutX ** 2.2
+    results = {}
+    for name in dtypes:
+        frame = numpy.empty(shape, dtype=name)
+        layer = numpy.random.random_sample(shape).astype(name)
+        best = None
+        for r in range(repeat):
+            start = monotonic()
+            for i in range(iterations):
+                frame.fill(0)
+                numpy.add(frame, layer, frame)
+                numpy.multiply(frame, layer, frame)
+                numpy.sin(frame, frame)
+                frame[:] = numpy.interp(frame.reshape(-1), lutX, lutY).reshape(shape)
+                numpy.multiply(frame, 255, frame)
+                numpy.clip(frame, 0, 255, frame)
+                numpy.copyto(pixels, frame, casting='unsafe')
+            elapsed = (monotonic() - start) / iterations
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best
+    return results
+
+
+def frameDtype(spec=None, numLEDs=1000, cacheFilename=None):
+    """Resolve a frame dtype specification to a numpy dtype.
+
+       'spec' is one of frameDtypes, or 'auto' to benchmark them all on this machine and use
+       the fastest. The LED_FRAME_DTYPE environment variable, if set, overrides 'spec', so
+       a machine's choice can be pinned in its configuration. The default is float64.
+
+       Results of 'auto' are saved in a small JSON file (frameDtypeCache by default), keyed by
+       machine and NumPy version, so the benchmark only runs once per installation.
+       """
+    spec = os.getenv('LED_FRAME_DTYPE') or spec or 'float64'
+    if spec != 'auto':
+        if spec not in frameDtypes:
+            raise ValueError("Unknown frame dtype %r, expected 'auto' or one of %r" % (
+                spec, frameDtypes))
+        return numpy.dtype(spec)
+
+    cacheFilename = cacheFilename or frameDtypeCache
+    key = ' '.join(filter(None, [platform.machine(), platform.processor(),
+                                 'numpy-' + numpy.__version__]))
+    try:
+        with open(cacheFilename) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    if cache.get(key) in frameDtypes:
+        return numpy.dtype(cache[key])
+
+    times = benchmarkFrameDtypes(numLEDs)
+    best = min(times, key=times.get)
+    sys.stderr.write("Frame dtype benchmark: %s, using %s\n" % (
+        ', '.join('%s %.3f ms' % (name, times[name] * 1000) for name in frameDtypes), best))
+    cache[key] = best
+    try:
+        with open(cacheFilename, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+    except IOError as err:
+        sys.stderr.write("Can't save frame dtype choice to %s: %s\n" % (cacheFilename, err))
+    return numpy.dtype(best)
+
    
 class AnimationController(object):
     """Manages the main animation loop. Each EffectLayer from the 'layers' list is run in order to
@@ -17,12 +101,30 @@ class AnimationController(object):
        rate control, and handles the advancement of time in EffectParameters.
        """
 
-    def __init__(self, model, renderer, params=None, server=None):
-        self.opc = FastOPC(server)
+    def __init__(self, model, renderer, params=None, server=None, asyncSend=False,
+                 channelMap=None, opc=None, overload='skip', dtype=None, encoder=None):
+        # 'server' may list several OPC servers separated by commas. With asyncSend, frames
+        # are handed off to sender threads so that rendering never waits on a server.
+        # Alternatively, pass in any OPC client as 'opc', such as a ChannelSplitOPC.
+        # 'dtype' is the frame's element type, or 'auto'; see frameDtype().
+        # An 'encoder', such as a LUTEncoder, replaces frameToHardwareFormat and the usual
+        # clip-and-convert, doing gamma correction and white balance on the way out.
+        self.opc = opc or opcClient(server, asyncSend)
         self.model = model
         self.renderer = renderer
         self.params = params or EffectParameters()
 
+        # Per-model tables are built now, not in the middle of the show
+        self.renderer.prepare(model)
+
+        # All per-frame storage is allocated once, here, and reused for every frame.
+        # A ChannelMap sends each tree on its own OPC channel instead of everything on 0.
+        self.frameBuffer = FrameBuffer(model.numLEDs, channelMap=channelMap,
+                                       dtype=frameDtype(dtype, model.numLEDs), encoder=encoder)
+
+        # What to do when we can't keep up; see FrameScheduler.
+        self.scheduler = FrameScheduler(self.params, overload)
+
         self._fpsFrames = 0
         self._fpsTime = 0
         self._fpsLogPeriod = 0.5    # How often to log frame rate
@@ -30,49 +132,35 @@ class AnimationController(object):
     def advanceTime(self):
         """Update the timestep in EffectParameters.
 
-           This is where we enforce our target frame rate, by sleeping until the minimum amount
-           of time has elapsed since the previous frame. We try to synchronize our actual frame
-           rate with the target frame rate in a slightly loose way which allows some jitter in
-           our clock, but which keeps the frame rate centered around our ideal rate if we can keep up.
+           This is where we enforce our target frame rate, by waiting for the next frame's
+           deadline. The FrameScheduler keeps the deadlines on a fixed grid, so jitter in any
+           one frame doesn't accumulate, and decides what happens when we fall behind.
 
            This is also where we log the actual frame rate to the console periodically, so we can
-           tell how well we're doing.
+           tell how well we're doing, along with the render times of each layer on screen.
            """
 
-        now = time.time()
-        dt = now - self.params.time
-        dtIdeal = 1.0 / self.params.targetFrameRate
-
-        if dt > dtIdeal * 2:
-            # Big jump forward. This may mean we're just starting out, or maybe our animation is
-            # skipping badly. Jump immediately to the current time and don't look back.
-
-            self.params.time = now
-
-        else:
-            # We're approximately keeping up with our ideal frame rate. Advance our animation
-            # clock by the ideal amount, and insert delays where necessary so we line up the
-            # animation clock with the real-time clock.
-
-            self.params.time += dtIdeal
-            if dt < dtIdeal:
-                time.sleep(dtIdeal - dt)
+        self.scheduler.wait()
 
         # Log frame rate
 
+        now = monotonic()
         self._fpsFrames += 1
         if now > self._fpsTime + self._fpsLogPeriod:
             fps = self._fpsFrames / (now - self._fpsTime)
             self._fpsTime = now
             self._fpsFrames = 0
-            sys.stderr.write("%7.2f FPS\n" % fps)
+            sys.stderr.write("fps=%.2f target=%.1f missed=%d %s\n" % (
+                fps, self.params.targetFrameRate, self.scheduler.missedDeadlines,
+                self.renderer.statsLine()))
 
     def renderLayers(self):
         """Generate a complete frame of LED data by rendering each layer."""
 
-        # Note: You'd think it would be faster to use float32 on the rPI, but
-        #       32-bit floats take a slower path in NumPy sadly.
-        frame = numpy.zeros((self.model.numLEDs, 3))
+        # Note: You'd think it would always be faster to use float32 on the rPI, but
+        #       32-bit floats can take a slower path in NumPy. So the frame's dtype is
+        #       configurable, and 'auto' picks whichever is faster on the machine.
+        frame = self.frameBuffer.clear()
 
         self.renderer.render(self.model, self.params, frame)
         return frame
@@ -89,8 +177,9 @@ class AnimationController(object):
         """Render a frame and send it to the OPC server"""
         self.advanceTime()
         pixels = self.renderLayers()
-        self.frameToHardwareFormat(pixels)
-        self.opc.putPixels(0, pixels)
+        if self.frameBuffer.encoder is None:
+            self.frameToHardwareFormat(pixels)
+        self.opc.putFrame(self.frameBuffer)
 
     def drawingLoop(self):
         """Render frames forever or until keyboard interrupt"""
@@ -99,20 +188,408 @@ class AnimationController(object):
                 self.drawFrame()
         except KeyboardInterrupt:
             pass
-        
-        
-class FastOPC(object):
-    """High-performance Open Pixel Control client, using Numeric Python.
-       By default, assumes the OPC server is running on localhost. This may be overridden
-       with the OPC_SERVER environment variable, or the 'server' keyword argument.
+
+
+class FrameScheduler(object):
+    """Paces the animation loop. Each frame has an absolute deadline on a monotonic clock,
+       one frame period after the last, and wait() sleeps until it arrives. Animation time
+       (params.time) advances in exact frame periods, starting from the wall-clock time.
+
+       When a frame misses its deadline, the 'overload' policy decides what to do:
+
+         'skip'     Skip the deadlines we've missed. Animation time stays locked to real
+                    time, so motion keeps its speed but loses smoothness.
+         'stretch'  Start the schedule over from now. Animation time advances one period per
+                    frame no matter what, so motion stays smooth but slows down.
+         'adaptive' Like 'skip', but if we keep missing deadlines, lower targetFrameRate.
+                    It's raised back toward the original rate when there's slack again.
+
+       'missedDeadlines' and 'skippedFrames' count how often we've fallen behind, and
+       'slack' is the time we had to spare before the most recent deadline (negative if late).
        """
 
-    def __init__(self, server=None):
-        self.server = server or os.getenv('OPC_SERVER') or '127.0.0.1:7890'
-        self.host, port = self.server.split(':')
+    policies = ('skip', 'stretch', 'adaptive')
+
+    spinTime = 0.001        # Sleeping is coarse, so spend the last bit of each wait polling
+    resyncTime = 0.25       # Being this late means we stalled; restart the schedule instead
+    adaptPeriod = 1.0       # Seconds between adjustments to the frame rate
+    minFrameRate = 20.0
+
+    def __init__(self, params, overload='skip'):
+        if overload not in self.policies:
+            raise ValueError("Unknown overload policy %r, expected one of %r" % (
+                overload, self.policies))
+        self.params = params
+        self.overload = overload
+        self.deadline = None
+        self.slack = 0.0
+        self.missedDeadlines = 0
+        self.skippedFrames = 0
+
+        # Offset from the monotonic clock to wall-clock time, used as the animation clock
+        self.clockOffset = time.time() - monotonic()
+
+        self.maxFrameRate = params.targetFrameRate
+        self._adaptStart = None
+        self._adaptFrames = 0
+        self._adaptMisses = 0
+
+    def wait(self):
+        """Wait until the next frame is due, and set params.time to its animation time."""
+        period = 1.0 / self.params.targetFrameRate
+        now = monotonic()
+
+        if self.deadline is None:
+            # Just starting out. Animation time starts from the wall clock.
+            self.deadline = now
+            self.params.time = now + self.clockOffset
+            self._adaptStart = now
+            return
+
+        if now - self.deadline > self.resyncTime:
+            # We stalled badly. Start a fresh schedule from now. When stretching, animation
+            # time just takes its usual step, so the stall doesn't make it jump.
+            self.deadline = now
+            self._adaptStart = now
+            if self.overload == 'stretch':
+                self.params.time += period
+            else:
+                self.params.time = now + self.clockOffset
+            return
+
+        self.deadline += period
+        self.slack = self.deadline - now
+
+        if self.slack >= 0:
+            if self.slack > self.spinTime:
+                time.sleep(self.slack - self.spinTime)
+            while monotonic() < self.deadline:
+                time.sleep(0)
+            self.params.time += period
+        else:
+            self.missedDeadlines += 1
+            self._adaptMisses += 1
+            if self.overload == 'stretch':
+                self.deadline = now
+                self.params.time += period
+            else:
+                missed = int(-self.slack / period)
+                self.skippedFrames += missed
+                self.deadline += missed * period
+                self.params.time = self.deadline + self.clockOffset
+
+        if self.overload == 'adaptive':
+            self._adapt(now)
+
+    def _adapt(self, now):
+        self._adaptFrames += 1
+        if now - self._adaptStart < self.adaptPeriod:
+            return
+        missRate = float(self._adaptMisses) / self._adaptFrames
+        rate = self.params.targetFrameRate
+        if missRate > 0.1:
+            rate = max(self.minFrameRate, rate * 0.9)
+        elif missRate == 0:
+            rate = min(self.maxFrameRate, rate * 1.05)
+        self.params.targetFrameRate = rate
+        self._adaptStart = now
+        self._adaptFrames = 0
+        self._adaptMisses = 0
+
+
+class ChannelMap(object):
+    """Maps the Model's LED indices onto OPC channels, so each tree's strand can go out as its
+       own OPC message, and possibly to its own server or SPI bus.
+
+       By default tree N (Model.edgeTree, counting from zero) goes to channel N+1, since OPC
+       channel 0 is a broadcast to all channels. 'channelForTree' may be a list or dict that
+       assigns channels explicitly; trees which share a channel are concatenated in tree
+       order. Within a channel, LEDs keep their order from the model.
+
+       'channels' is the sorted list of channel numbers, and 'indices' holds the matching
+       arrays of LED indices, so splitting a frame is just fancy indexing.
+       """
+
+    def __init__(self, model, channelForTree=None):
+        trees = sorted(set(model.edgeTree))
+        if channelForTree is None:
+            channelForTree = dict((tree, tree + 1) for tree in trees)
+        elif not isinstance(channelForTree, dict):
+            channelForTree = dict(enumerate(channelForTree))
+
+        ledsForChannel = {}
+        for tree in trees:
+            leds = numpy.nonzero(model.edgeTree == tree)[0]
+            ledsForChannel.setdefault(channelForTree[tree], []).append(leds)
+
+        self.numLEDs = model.numLEDs
+        self.channels = sorted(ledsForChannel)
+        self.indices = [numpy.concatenate(ledsForChannel[c]) for c in self.channels]
+
+
+class FrameBuffer(object):
+    """Preallocated storage for one frame: the floating-point frame that the effect layers
+       render into, and a persistent bytearray holding a complete OPC message (header and
+       8-bit payload) for that frame. The payload is exposed as a uint8 numpy view so
+       encoding never allocates, and the message can be sent straight from a memoryview.
+
+       With a ChannelMap, the bytearray instead holds one message per channel back to back,
+       and encoding scatters each LED to its place through a precomputed index array.
+       'channelMessages' lists (channel, memoryview) for each message, for sending
+       channels to different places.
+
+       'dtype' is the frame's element type, float64 or float32; see frameDtype().
+
+       With an 'encoder' (see LUTEncoder), frames are encoded straight from the effect layers'
+       0-1 format, and the encoder takes care of clipping and conversion.
+       """
+
+    headerSize = 4
+
+    def __init__(self, numLEDs, channel=0, channelMap=None, dtype=numpy.float64, encoder=None):
+        self.numLEDs = numLEDs
+        self.encoder = encoder
+        self.frame = numpy.zeros((numLEDs, 3), dtype=dtype)
+
+        if channelMap is None:
+            layout = [(channel, numpy.arange(numLEDs))]
+        else:
+            layout = zip(channelMap.channels, channelMap.indices)
+
+        self.message = bytearray(sum(self.headerSize + len(leds) * 3 for c, leds in layout))
+        self.view = memoryview(self.message)
+        self.channelMessages = []
+
+        # Byte offset in 'message' of each color component of each LED
+        payloadIndex = numpy.zeros((numLEDs, 3), dtype=numpy.intp)
+        offset = 0
+        for c, leds in layout:
+            payloadSize = len(leds) * 3
+            struct.pack_into('>BBH', self.message, offset,
+                c,
+                0x00,  # Command
+                payloadSize)
+            start = offset + self.headerSize
+            payloadIndex[leds] = numpy.arange(start, start + payloadSize).reshape(-1, 3)
+            offset = start + payloadSize
+            self.channelMessages.append((c, self.view[start - self.headerSize:offset]))
+
+        if channelMap is None:
+            self.pixels = numpy.frombuffer(self.message, dtype=numpy.uint8,
+                offset=self.headerSize).reshape(numLEDs, 3)
+            self._bytes = None
+        else:
+            self.pixels = numpy.zeros((numLEDs, 3), dtype=numpy.uint8)
+            self._bytes = numpy.frombuffer(self.message, dtype=numpy.uint8)
+            self._payloadIndex = payloadIndex.reshape(-1)
+
+    def clear(self):
+        """Zero the float frame in-place and return it, ready for rendering."""
+        self.frame.fill(0)
+        return self.frame
+
+    def encode(self, pixels=None):
+        """Clip a frame in hardware format (0-255, see frameToHardwareFormat) and convert it
+           into the message payload. Defaults to our own float frame. 'pixels' is clipped
+           in-place. With an encoder, 'pixels' is in 0-1 format instead, and left alone.
+           """
+        if pixels is None:
+            pixels = self.frame
+        if self.encoder is not None:
+            self.encoder.encode(pixels.reshape(self.pixels.shape), self.pixels)
+        else:
+            numpy.clip(pixels, 0, 255, pixels)
+            numpy.copyto(self.pixels, pixels.reshape(self.pixels.shape), casting='unsafe')
+        if self._bytes is not None:
+            self._bytes[self._payloadIndex] = self.pixels.reshape(-1)
+        return self.view
+
+
+class LUTEncoder(object):
+    """The whole output stage in one table lookup per color component: gamma correction,
+       white balance and conversion of 0-1 floats to 8-bit hardware values.
+
+       The frame is quantized to 'size' levels per component, and each (channel, level)
+       indexes a precomputed uint8 table, which numpy.take() writes straight into the OPC
+       message. 4096 levels keep the dark end smooth; 256 quantizes as coarsely as the
+       8-bit output before the gamma curve, and only saves a few kilobytes of table.
+
+       'gamma' and 'whiteBalance' are either one value or an (r, g, b) triple, so strands
+       with uneven color response, like the WS2801s, can be corrected per channel.
+       'whiteBalance' scales each channel's full brightness.
+       """
+
+    def __init__(self, gamma=2.2, whiteBalance=1.0, size=4096):
+        self.size = size
+        self.gamma = numpy.zeros(3) + gamma
+        self.whiteBalance = numpy.zeros(3) + whiteBalance
+
+        # Level i stands for the frame values which truncate to it, so it's looked up at
+        # the middle of that range.
+        levels = numpy.minimum(1.0, (numpy.arange(size) + 0.5) / (size - 1))
+        table = numpy.power(levels, self.gamma.reshape(3, 1))
+        table *= (255 * self.whiteBalance).reshape(3, 1)
+
+        # Channel-major, with each channel's table offset added to its indices.
+        # 'exact' keeps the unrounded values, in 0-255, for subclasses.
+        self.exact = numpy.clip(table, 0, 255).reshape(-1)
+        self.lut = numpy.round(self.exact).astype(numpy.uint8)
+        self.offsets = numpy.arange(3) * size
+        self._index = None
+
+    def lookup(self, frame):
+        """Quantize an (N, 3) frame in 0-1 format to indices into 'lut' and 'exact'.
+           Returns a buffer which is reused on the next call.
+           """
+        index = self._index
+        if index is None or index.shape != frame.shape:
+            index = self._index = numpy.empty(frame.shape, dtype=numpy.intp)
+        numpy.multiply(frame, self.size - 1, index, casting='unsafe')
+        numpy.clip(index, 0, self.size - 1, index)
+        numpy.add(index, self.offsets, index)
+        return index
+
+    def encode(self, frame, out):
+        """Encode an (N, 3) frame in 0-1 format into the (N, 3) uint8 array 'out'."""
+        numpy.take(self.lut, self.lookup(frame), out=out, mode='clip')
+        return out
+
+
+class DitheringEncoder(LUTEncoder):
+    """A LUTEncoder with temporal dithering, for more apparent bit depth at the dark end,
+       where the gamma curve leaves only a few 8-bit steps and slow fades band.
+
+       Each LED keeps the error between the value it should have had and the 8-bit value it
+       was sent, and adds it to the next frame's value before rounding. Over a few frames
+       the average output matches the exact value. The error is always under half a step,
+       so black stays black. All buffers are preallocated; per frame it costs a few more
+       passes over the frame than LUTEncoder.
+       """
+
+    def __init__(self, gamma=2.2, whiteBalance=1.0, size=4096):
+        super(DitheringEncoder, self).__init__(gamma, whiteBalance, size)
+        self.exact = self.exact.astype(numpy.float32)
+        self.error = None
+
+    def encode(self, frame, out):
+        """Encode an (N, 3) frame in 0-1 format into the (N, 3) uint8 array 'out'."""
+        if self.error is None or self.error.shape != frame.shape:
+            self.error = numpy.zeros(frame.shape, dtype=numpy.float32)
+            self._wanted = numpy.empty(frame.shape, dtype=numpy.float32)
+            self._sent = numpy.empty(frame.shape, dtype=numpy.float32)
+        wanted, sent = self._wanted, self._sent
+
+        numpy.take(self.exact, self.lookup(frame), out=wanted, mode='clip')
+        numpy.add(wanted, self.error, wanted)
+        numpy.rint(wanted, sent)
+        numpy.clip(sent, 0, 255, sent)
+        numpy.subtract(wanted, sent, self.error)
+        numpy.copyto(out, sent, casting='unsafe')
+        return out
+
+
+def opcClient(server=None, asyncSend=False):
+    """Create the OPC client for a server specification. By default this is the OPC_SERVER
+       environment variable, or localhost. Several servers may be given, separated by commas,
+       in which case each frame is encoded once and sent to all of them.
+       """
+    spec = server or os.getenv('OPC_SERVER') or '127.0.0.1:7890'
+    servers = [s.strip() for s in spec.split(',') if s.strip()]
+    clientClass = AsyncOPC if asyncSend else FastOPC
+    if len(servers) == 1:
+        return clientClass(servers[0])
+    return FanoutOPC([clientClass(s) for s in servers])
+
+
+class OPCConnection(object):
+    """A TCP connection to one OPC server, which recovers when the server goes away.
+
+       send() never blocks on connecting. If there's no connection, the frame is dropped and
+       a reconnect is attempted on a background thread, with exponential backoff between
+       attempts so a missing server doesn't cost us anything per frame.
+       """
+
+    minBackoff = 0.1        # Seconds before the first reconnect attempt
+    maxBackoff = 5.0        # Longest time between reconnect attempts
+    timeout = 2.0           # Connect and send timeout. A stalled send drops the connection.
+
+    def __init__(self, server):
+        self.server = server
+        self.host, port = server.split(':')
         self.port = int(port)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.host, self.port))
+        self.socket = None
+        self.backoff = self.minBackoff
+        self.retryTime = 0
+        self._connecting = False
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """Try to connect right away. Returns True if we're connected."""
+        try:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+        except socket.error as err:
+            self._failed("Can't connect to", err)
+            return False
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket = sock
+        self.backoff = self.minBackoff
+        sys.stderr.write("Connected to OPC server %s\n" % self.server)
+        return True
+
+    def send(self, data):
+        """Send all of 'data'. Returns False, and schedules a reconnect, if we aren't
+           connected or the connection fails partway through.
+           """
+        sock = self.socket
+        if sock is None:
+            self._reconnectLater()
+            return False
+        try:
+            sock.sendall(data)
+            return True
+        except socket.error as err:
+            # Part of a message may have gone out, so the stream is unusable now.
+            self.socket = None
+            sock.close()
+            self._failed("Lost connection to", err)
+            return False
+
+    def _failed(self, what, err):
+        sys.stderr.write("%s OPC server %s: %s\n" % (what, self.server, err))
+        self.retryTime = monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, self.maxBackoff)
+
+    def _reconnectLater(self):
+        with self._lock:
+            if self._connecting or monotonic() < self.retryTime:
+                return
+            self._connecting = True
+        thread = threading.Thread(target=self._reconnect, name='OPC connect %s' % self.server)
+        thread.daemon = True
+        thread.start()
+
+    def _reconnect(self):
+        try:
+            self.connect()
+        finally:
+            self._connecting = False
+
+
+class OPCClient(object):
+    """Base class for Open Pixel Control clients. Subclasses implement putMessage()."""
+
+    def putFrame(self, frameBuffer):
+        """Encode and send the frame held by a FrameBuffer, without any intermediate copies.
+           The frame must already be in hardware format.
+           """
+        self.putMessage(frameBuffer.encode())
+
+    def putMessage(self, data):
+        """Send one or more complete, already-encoded OPC messages. Returns True if they
+           were sent, False if they were dropped, or None if the client chose to skip them
+           (see DeltaOPC.maxFrameRate).
+           """
+        raise NotImplementedError("Implement putMessage() in your OPCClient subclass")
 
     def putPixels(self, channel, pixels):
         """Send a list of 8-bit colors to the indicated channel. (OPC command 0x00).
@@ -122,10 +599,324 @@ class FastOPC(object):
            'pixels' is clipped in-place. If any values are out of range, the array is modified.
            """
 
-        numpy.clip(pixels, 0, 255, pixels)
-        packedPixels = pixels.astype('B').tostring()
-        header = struct.pack('>BBH',
-            channel,
-            0x00,  # Command
-            len(packedPixels))
-        self.socket.send(header + packedPixels)
+        # Scratch buffers, keyed by (channel, number of LEDs)
+        if not hasattr(self, '_buffers'):
+            self._buffers = {}
+        key = (channel, pixels.size // 3)
+        frameBuffer = self._buffers.get(key)
+        if frameBuffer is None:
+            frameBuffer = self._buffers[key] = FrameBuffer(key[1], channel)
+        self.putMessage(frameBuffer.encode(pixels))
+
+
+class FastOPC(OPCClient):
+    """High-performance Open Pixel Control client, using Numeric Python.
+       By default, assumes the OPC server is running on localhost. This may be overridden
+       with the OPC_SERVER environment variable, or the 'server' keyword argument.
+
+       If the server isn't reachable, or goes away, frames are dropped until an
+       automatic reconnect succeeds.
+       """
+
+    def __init__(self, server=None):
+        self.server = server or os.getenv('OPC_SERVER') or '127.0.0.1:7890'
+        self.connection = OPCConnection(self.server)
+        self.host = self.connection.host
+        self.port = self.connection.port
+        self.connection.connect()
+
+    @property
+    def socket(self):
+        return self.connection.socket
+
+    def putMessage(self, data):
+        """Send one or more complete, already-encoded OPC messages. Blocks until all of
+           'data' has been written; a short write never truncates a frame. Returns False if
+           the message was dropped because we aren't connected.
+           """
+        return self.connection.send(data)
+
+
+class AsyncOPC(OPCClient):
+    """Open Pixel Control client which does all of its socket I/O on a dedicated thread.
+
+       Frames are handed over through a single slot: putFrame() copies the encoded message
+       into the slot and returns immediately, and the sender thread swaps it out and writes
+       it to the socket. If the server falls behind, a frame still waiting in the slot is
+       overwritten by the newer one, so stale frames are dropped rather than queued.
+
+       'framesSent' and 'framesDropped' count what happened to each frame, including frames
+       dropped while disconnected, and 'framesSkipped' frames the client chose not to send.
+       An unexpected error on the sender thread is raised again from the next putFrame()
+       call.
+
+       The sending is done by a FastOPC for 'server', or by any other blocking OPC client
+       passed in as 'client', such as a DeltaOPC.
+       """
+
+    def __init__(self, server=None, client=None):
+        self.client = client or FastOPC(server)
+        self.server = self.client.server
+        self.framesSent = 0
+        self.framesDropped = 0
+        self.framesSkipped = 0
+        self.error = None
+
+        # Double buffer: the render thread fills _pending, the sender thread owns _sending.
+        self._pending = bytearray()
+        self._sending = bytearray()
+        self._hasPending = False
+        self._condition = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, name='AsyncOPC %s' % self.server)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def putMessage(self, data):
+        """Queue complete, already-encoded OPC messages for sending, replacing any message
+           which hasn't been picked up by the sender thread yet. Never blocks on the socket.
+           """
+        if self.error is not None:
+            raise self.error
+        with self._condition:
+            if self._hasPending:
+                self.framesDropped += 1
+            if len(self._pending) != len(data):
+                self._pending = bytearray(len(data))
+            self._pending[:] = data
+            self._hasPending = True
+            self._condition.notify()
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    while not self._hasPending:
+                        self._condition.wait()
+                    self._pending, self._sending = self._sending, self._pending
+                    self._hasPending = False
+                sent = self.client.putMessage(self._sending)
+                with self._condition:
+                    if sent is None:
+                        self.framesSkipped += 1
+                    elif sent:
+                        self.framesSent += 1
+                    else:
+                        self.framesDropped += 1
+        except Exception as err:
+            self.error = err
+
+
+class ChannelSplitOPC(OPCClient):
+    """Sends each channel of a frame encoded with a ChannelMap to its own OPC client, so
+       strands can be driven by separate servers in parallel. 'clientForChannel' is a dict
+       of channel number to client; channels without a client aren't sent anywhere.
+       """
+
+    def __init__(self, clientForChannel):
+        self.clientForChannel = clientForChannel
+        self.server = ','.join('%d=%s' % (c, client.server)
+            for c, client in sorted(clientForChannel.items()))
+
+    def putFrame(self, frameBuffer):
+        frameBuffer.encode()
+        for channel, message in frameBuffer.channelMessages:
+            client = self.clientForChannel.get(channel)
+            if client is not None:
+                client.putMessage(message)
+
+    def putMessage(self, data):
+        raise NotImplementedError("ChannelSplitOPC can only send whole frames, with putFrame()")
+
+
+class FanoutOPC(OPCClient):
+    """Sends each frame to several OPC clients, for example the LEDs plus a gl_server
+       preview. The frame is encoded once and the same message goes to every client.
+       """
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.server = ','.join(client.server for client in clients)
+
+    def putMessage(self, data):
+        # Every client gets the frame, even after one fails; it's sent only if all sent it
+        return all([client.putMessage(data) for client in self.clients])
+
+
+class DeltaOPC(OPCClient):
+    """Open Pixel Control client for remote previews over slow links. Instead of every frame
+       in full, it sends an occasional keyframe and, in between, only the byte ranges which
+       changed since the last frame sent. preview_receiver.py, next to the OPC server on
+       the other end, rebuilds the frames (see DeltaDecoder) and forwards them.
+
+       Both kinds of update travel as OPC system exclusive messages (command 0xFF) tagged
+       with our 'systemId'. The payload after the system ID is a kind byte, then either
+       KEYFRAME: the complete encoded OPC message(s) for the frame, or
+       DELTA: ranges, each an (offset, length) header followed by that many new bytes.
+
+       Bytes which moved by no more than 'threshold' aren't counted as changed, so temporal
+       dithering doesn't defeat the scheme; the preview may be off by that much. Changed
+       bytes less than a range header apart are sent as one range. A keyframe goes out every
+       'keyframeInterval' seconds, after reconnecting, and whenever a delta wouldn't be
+       smaller. Like FastOPC this blocks on the socket, so wrap it in an AsyncOPC to keep
+       a slow link from holding up rendering: frames the link can't keep up with are then
+       dropped, and the next delta is simply larger.
+
+       'maxFrameRate', if given, skips frames which come sooner than that after the last one
+       sent. A preview rarely needs the full frame rate, and skipping frames costs little
+       more per delta. putMessage() returns None for those, and counts them in
+       'framesSkipped'.
+
+       'bytesSent' and 'bytesFull' count what was sent and what sending every frame in full
+       would have cost.
+       """
+
+    systemId = 0x4D41       # 'MA'
+    KEYFRAME = 0
+    DELTA = 1
+
+    header = struct.Struct('>BBHHB')    # Channel, command, length, system ID, kind
+    rangeHeader = struct.Struct('>IH')  # Offset, length
+    maxPayload = 0xFFFF
+
+    def __init__(self, server, keyframeInterval=2.0, threshold=1, maxFrameRate=None):
+        self.server = server
+        self.connection = OPCConnection(server)
+        self.keyframeInterval = keyframeInterval
+        self.threshold = threshold
+        self.maxFrameRate = maxFrameRate
+        self.sentTime = None
+        self.framesSkipped = 0
+        self.bytesSent = 0
+        self.bytesFull = 0
+
+        # What the receiver has, if it's up to date
+        self.sent = None
+        self.keyframeTime = None
+        self.connection.connect()
+
+    def putMessage(self, data):
+        """Send the changes between the last frame sent and 'data', which holds complete,
+           already-encoded OPC messages. Returns False if we aren't connected, and None if
+           the frame was skipped to keep under maxFrameRate.
+           """
+        frame = numpy.asarray(memoryview(data))
+        self.bytesFull += len(frame)
+        now = monotonic()
+        if (self.maxFrameRate and self.sent is not None and
+                now - self.sentTime < 1.0 / self.maxFrameRate):
+            self.framesSkipped += 1
+            return None
+        message = None
+        if (self.sent is not None and len(self.sent) == len(frame) and
+                now - self.keyframeTime < self.keyframeInterval):
+            ranges = self._changedRanges(frame)
+            if ranges is None:
+                return True
+            starts, ends = ranges
+            size = (self.header.size + len(starts) * self.rangeHeader.size +
+                    int((ends - starts).sum()))
+            if size < self.header.size + len(frame):
+                message = self._delta(data, size, starts, ends)
+        if message is None:
+            message = self._keyframe(data)
+            self.keyframeTime = now
+
+        if not self.connection.send(message):
+            self.sent = None
+            return False
+        self.sentTime = now
+        self.bytesSent += len(message)
+        return True
+
+    def _keyframe(self, data):
+        frame = numpy.asarray(memoryview(data))
+        size = self.header.size + len(frame)
+        if size - 4 > self.maxPayload:
+            raise ValueError("Frame too large for a DeltaOPC keyframe: %d bytes" % len(frame))
+        message = bytearray(size)
+        self.header.pack_into(message, 0, 0, 0xFF, size - 4, self.systemId, self.KEYFRAME)
+        message[self.header.size:] = data
+        if self.sent is None or len(self.sent) != len(frame):
+            self.sent = frame.copy()
+            self._difference = numpy.empty(len(frame), dtype=numpy.int16)
+            self._changed = numpy.empty(len(frame), dtype=bool)
+        else:
+            self.sent[:] = frame
+        return message
+
+    def _changedRanges(self, frame):
+        # (starts, ends) of the byte ranges which changed, or None if nothing did
+        numpy.subtract(frame, self.sent, self._difference, dtype=numpy.int16)
+        numpy.abs(self._difference, self._difference)
+        numpy.greater(self._difference, self.threshold, self._changed)
+        changed = numpy.flatnonzero(self._changed)
+        if not len(changed):
+            return None
+        breaks = numpy.flatnonzero(numpy.diff(changed) > self.rangeHeader.size)
+        starts = changed[numpy.concatenate(([0], breaks + 1))]
+        ends = changed[numpy.concatenate((breaks, [len(changed) - 1]))] + 1
+        return starts, ends
+
+    def _delta(self, data, size, starts, ends):
+        frame = numpy.asarray(memoryview(data))
+        view = memoryview(data)
+        message = bytearray(size)
+        self.header.pack_into(message, 0, 0, 0xFF, size - 4, self.systemId, self.DELTA)
+        offset = self.header.size
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            self.rangeHeader.pack_into(message, offset, start, end - start)
+            offset += self.rangeHeader.size
+            message[offset:offset + end - start] = view[start:end]
+            offset += end - start
+            self.sent[start:end] = frame[start:end]
+        return message
+
+
+class DeltaDecoder(object):
+    """Rebuilds frames from the system exclusive messages sent by a DeltaOPC. 'frame' is a
+       bytearray holding the latest complete OPC message(s), or None until the first
+       keyframe arrives.
+       """
+
+    def __init__(self):
+        self.frame = None
+
+    def decode(self, payload):
+        """Apply the payload of one DeltaOPC message (everything after the OPC header).
+           Returns True if 'frame' was updated, False for messages which aren't ours or
+           deltas we have no keyframe for. Raises ValueError for a malformed delta, without
+           applying any of it.
+           """
+        header = DeltaOPC.header
+        if len(payload) < header.size - 4:
+            return False
+        systemId, kind = struct.unpack_from('>HB', payload)
+        body = memoryview(payload)[header.size - 4:]
+        if systemId != DeltaOPC.systemId:
+            return False
+        if kind == DeltaOPC.KEYFRAME:
+            self.frame = bytearray(body)
+            return True
+        if kind != DeltaOPC.DELTA or self.frame is None:
+            return False
+
+        rangeHeader = DeltaOPC.rangeHeader
+        ranges = []
+        offset = 0
+        while offset < len(body):
+            if offset + rangeHeader.size > len(body):
+                raise ValueError("Truncated range header at byte %d of a delta" % offset)
+            start, length = rangeHeader.unpack_from(body, offset)
+            offset += rangeHeader.size
+            if offset + length > len(body):
+                raise ValueError("Range of %d bytes runs past the end of a delta" % length)
+            if start + length > len(self.frame):
+                raise ValueError("Range %d-%d is outside the %d byte frame" % (
+                    start, start + length, len(self.frame)))
+            ranges.append((start, length, offset))
+            offset += length
+
+        for start, length, offset in ranges:
+            self.frame[start:start + length] = body[offset:offset + length]
+        return True
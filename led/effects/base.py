@@ -1,9 +1,11 @@
 from __future__ import print_function
+import math
 import numpy
 import time
 import traceback
 import colorsys
 import random
+from led.clock import monotonic
 
 class EffectParameters(object):
     """Inputs to the individual effect layers. Includes basics like the timestamp of the frame we're
@@ -15,6 +17,88 @@ class EffectParameters(object):
     eeg = None
 
 
+class RenderTimer(object):
+    """Remembers the most recent render durations in a fixed-size ring buffer. Recording is
+       a single array store, so this is cheap enough to run for every layer on every frame.
+       """
+
+    size = 256
+
+    def __init__(self, size=None):
+        self.samples = numpy.zeros(size or self.size)
+        self.count = 0
+
+    def record(self, seconds):
+        self.samples[self.count % len(self.samples)] = seconds
+        self.count += 1
+
+    def recent(self):
+        """The durations currently held in the buffer, in seconds, oldest first."""
+        n = len(self.samples)
+        if self.count < n:
+            return self.samples[:self.count]
+        i = self.count % n
+        return numpy.concatenate((self.samples[i:], self.samples[:i]))
+
+    def stats(self):
+        """Rolling statistics in milliseconds, as a dict with mean, p50, p99 and max,
+           or None if nothing has been recorded yet.
+           """
+        if not self.count:
+            return None
+        ms = self.recent() * 1000.0
+        p50, p99 = numpy.percentile(ms, [50, 99])
+        return {'mean': ms.mean(), 'p50': p50, 'p99': p99, 'max': ms.max()}
+
+
+class FramePool(object):
+    """Scratch frames for layers and fades which need somewhere to render besides the
+       main frame. Frames are handed out with acquire() and given back with release(), and
+       get reused, so nothing is allocated per frame once things are warmed up. Frames come
+       back with whatever was in them last time.
+       """
+
+    def __init__(self):
+        self.free = {}
+
+    def acquire(self, shape, dtype=numpy.float64):
+        free = self.free.get((tuple(shape), numpy.dtype(dtype)))
+        if free:
+            return free.pop()
+        return numpy.empty(shape, dtype)
+
+    def release(self, frame):
+        self.free.setdefault((frame.shape, frame.dtype), []).append(frame)
+
+# Shared by everything that renders on the main thread
+framePool = FramePool()
+
+
+def blend(frame, layerFrame, mode, pool=framePool):
+    """Combine 'layerFrame' into 'frame' in place according to a blend 'mode' (see
+       EffectLayer), in one or two passes.
+       """
+    if mode == 'add':
+        numpy.add(frame, layerFrame, frame)
+    elif mode == 'multiply':
+        numpy.multiply(frame, layerFrame, frame)
+    elif mode in ('modulate', 'over'):
+        # Per-LED brightness (modulate) or coverage (over) of the layer
+        weight = pool.acquire(frame.shape[:1], frame.dtype)
+        if mode == 'modulate':
+            numpy.mean(layerFrame, axis=1, out=weight)
+        else:
+            numpy.amax(layerFrame, axis=1, out=weight)
+            numpy.clip(weight, 0, 1, weight)
+            numpy.subtract(1, weight, weight)
+        numpy.multiply(frame, weight.reshape(-1, 1), frame)
+        if mode == 'over':
+            numpy.add(frame, layerFrame, frame)
+        pool.release(weight)
+    else:
+        raise ValueError("Unknown blend mode %r" % (mode,))
+
+
 class EffectLayer(object):
     """Abstract base class for one layer of an LED light effect. Layers operate on a shared framebuffer,
        adding their own contribution to the buffer and possibly blending or overlaying with data from
@@ -25,20 +109,78 @@ class EffectLayer(object):
        blue components each as floating point values with a normalized brightness range of [0, 1].
        If a component is beyond this range, it will be clamped during conversion to the hardware
        color format.
+
+       By default a layer works on the shared frame directly. Layers can instead set
+       'blendMode' to have the renderer's Compositor give them a blank scratch frame, and
+       combine what they draw there with the frame below:
+
+         'add'       frame + layer (additive layers just draw straight into the frame)
+         'multiply'  frame * layer, per color channel
+         'modulate'  frame * layer brightness, the mean of the layer's channels
+         'over'      the layer on top, letting the frame show through where it's dark
        """
 
     transitionFadeTime = 1.0
     maximum_errors = 5
 
+    # Rendering quality in (0, 1], lowered by the renderer's QualityGovernor when frames run
+    # over budget. Layers which are 'additive' only ever add their own contribution to the
+    # frame, so at reduced quality they can be rendered every few frames, with their last
+    # contribution added again in between.
+    quality = 1.0
+    additive = False
+    render_every = 1
+
+    blendMode = None
+
     def render(self, model, params, frame):
         raise NotImplementedError("Implement render() in your EffectLayer subclass")
 
+    def prepare(self, model):
+        """Build any per-model tables ahead of time, so the first frame on screen doesn't
+           pay for them. The Renderer calls this for every layer when the model is loaded.
+           Layers must still work if it wasn't called.
+           """
+        pass
+
+    def set_quality(self, quality):
+        """Switch to a cheaper (or back to a better) way of rendering, for a quality level in
+           (0, 1]. Layers with their own quality knobs override this. By default, additive
+           layers render less often. Returns False, leaving the layer as it was, if this
+           level wouldn't be any cheaper than the current one.
+           """
+        self.quality = quality
+        if not self.additive:
+            return False
+        # Round up, so any quality below 1 renders less often. The tolerance keeps levels
+        # like 1/3 from landing a step too far.
+        self.render_every = int(math.ceil(1.0 / quality - 1e-6))
+        return True
+
+    def _render_reusing_contribution(self, model, params, frame):
+        # Render into our own buffer every 'render_every' frames, and add it to every frame
+        contribution = getattr(self, '_contribution', None)
+        if contribution is None or contribution.shape != frame.shape:
+            contribution = self._contribution = numpy.zeros(frame.shape, frame.dtype)
+            self._contribution_age = 0
+        if self._contribution_age % self.render_every == 0:
+            contribution.fill(0)
+            self.render(model, params, contribution)
+        self._contribution_age += 1
+        numpy.add(frame, contribution, frame)
+
     def safely_render(self, model, params, frame):
         if not hasattr(self, 'error_count'):
             self.error_count = 0
+            self.render_timer = RenderTimer()
         try:
             if self.error_count < EffectLayer.maximum_errors:
-                self.render(model, params, frame)
+                start = monotonic()
+                if self.render_every > 1:
+                    self._render_reusing_contribution(model, params, frame)
+                else:
+                    self.render(model, params, frame)
+                self.render_timer.record(monotonic() - start)
         except Exception as err:
             error_log = open('error.log','a')
             error_log.write(time.asctime(time.gmtime()) + " UTC" + " : ")
@@ -151,20 +293,28 @@ class RGBLayer(EffectLayer):
 
 
 class MultiplierLayer(EffectLayer):
-    """ Renders two layers in temporary frames, then adds the product of those frames
-    to the frame passed into its render method
+    """ Renders two layers and adds their product to the frame. In 'add' mode the
+    Compositor hands us a blank frame of our own, which the first layer draws into and
+    the second is then blended onto with 'multiply'.
     """
+
+    blendMode = 'add'
+
     def __init__(self, layer1, layer2):
         self.layer1 = layer1
         self.layer2 = layer2        
+
+    def prepare(self, model):
+        self.layer1.prepare(model)
+        self.layer2.prepare(model)
         
     def render(self, model, params, frame):
-        temp1 = numpy.zeros(frame.shape)
-        temp2 = numpy.zeros(frame.shape)
-        self.layer1.render(model, params, temp1)
-        self.layer2.render(model, params, temp2)
-        numpy.multiply(temp1, temp2, temp1)
-        numpy.add(frame, temp1, frame)
+        self.layer1.render(model, params, frame)
+        temp = framePool.acquire(frame.shape, frame.dtype)
+        temp.fill(0)
+        self.layer2.render(model, params, temp)
+        blend(frame, temp, 'multiply')
+        framePool.release(temp)
 
 
 class BlinkyLayer(EffectLayer):
@@ -187,12 +337,14 @@ class ColorBlinkyLayer(EffectLayer):
 
 class SnowstormLayer(EffectLayer):
     transitionFadeTime = 1.0
+    additive = True
     def render(self, model, params, frame):
         numpy.add(frame, numpy.random.rand(model.numLEDs, 1), frame)
 
 
 class TechnicolorSnowstormLayer(EffectLayer):
     transitionFadeTime = 1.5
+    additive = True
     def render(self, model, params, frame):
         numpy.add(frame, numpy.random.rand(model.numLEDs, 3), frame)
 
@@ -201,8 +353,9 @@ class WhiteOutLayer(EffectLayer):
     """ Sets everything to white """
 
     transitionFadeTime = 0.5
+    additive = True
     def render(self, model, params, frame):
-        frame += numpy.ones(frame.shape)
+        frame += 1
             
 
 class GammaLayer(EffectLayer):
@@ -214,6 +367,7 @@ class GammaLayer(EffectLayer):
         self.lutY = numpy.power(self.lutX, gamma)
 
     def render(self, model, params, frame):
+        # interp() always answers in float64; copying back converts to the frame's dtype
         frame[:] = numpy.interp(frame.reshape(-1), self.lutX, self.lutY).reshape(frame.shape)
 
 
@@ -3,15 +3,18 @@
 #include <stdio.h>
 
 #define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
-//#include <numpy/noprefix.h>
 #include <numpy/arrayobject.h>
 #include "noise.h"
 
-float noise3(float x, float y, float z,
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+static float noise3(float x, float y, float z,
 			 const int repeatx, const int repeaty, const int repeatz,
 			 const int base);
 
-inline static double make_noise(double x, double y, double z, int octaves)
+static inline double make_noise(double x, double y, double z, int octaves)
 // Copied out of _perlin.c of python noise module
 {
 	double freq = 1.0f;
@@ -39,6 +42,44 @@ inline static double make_noise(double x, double y, double z, int octaves)
 	return (double) (total / max);
 }
 
+// Turn noise in [-1, 1] into a brightness, mostly in [0, 1]
+#define SHAPE_NOISE(n) (1.2f*(n) + (1.2f*0.35f))
+
+static PyArrayObject *as_double_array(PyObject *obj, const char *name)
+{
+	// Any sequence works; strided numpy views (like edgeCenters[:,0]) get copied
+	PyArrayObject *array = (PyArrayObject*)PyArray_FROM_OTF(obj, NPY_DOUBLE,
+		NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+	if (array == NULL)
+		return NULL;
+	if (PyArray_NDIM(array) != 1) {
+		PyErr_Format(PyExc_ValueError, "%s must be one-dimensional", name);
+		Py_DECREF(array);
+		return NULL;
+	}
+	return array;
+}
+
+// Frames and noise buffers may be float64 or float32
+#define IS_FLOAT_ARRAY(a) (PyArray_TYPE(a) == NPY_DOUBLE || PyArray_TYPE(a) == NPY_FLOAT)
+
+#define APPLY_NOISE(type) \
+	{ \
+		type *pixels = (type *) PyArray_DATA(frame); \
+		for (i = 0; i < count; ++i) { \
+			double n = SHAPE_NOISE(make_noise(x[i] * zoom, y[i] * zoom, z[i] * zoom + z0, octaves)); \
+			if (modulate) { \
+				pixels[3*i] *= n; \
+				pixels[3*i+1] *= n; \
+				pixels[3*i+2] *= n; \
+			} else { \
+				pixels[3*i] += n * color[0]; \
+				pixels[3*i+1] += n * color[1]; \
+				pixels[3*i+2] += n * color[2]; \
+			} \
+		} \
+	}
+
 static PyObject* py_render(PyObject* self, PyObject* args)
 {
 	// values from python
@@ -47,169 +88,180 @@ static PyObject* py_render(PyObject* self, PyObject* args)
 	double time_const;
 	int octaves;
 	double time;
-	PyObject *py_frame;
-	int framelen;
+	PyArrayObject *frame;
+	double color[3] = {0, 0, 0};
 
 	// internal values
-	int i;
+	PyArrayObject *modelX = NULL, *modelY = NULL, *modelZ = NULL;
+	const double *x, *y, *z;
+	npy_intp i, count;
 	double z0;
-	PyArrayObject *modelXarray;
-        PyArrayObject *modelYarray;
-        PyArrayObject *modelZarray;
-        PyArrayObject *pixelarray;
-        double *modelX;
-	double *modelY;
-	double *modelZ;
-	double *scaledX;
-	double *scaledY;
-	double *scaledZ;
-	int modelXlen;
-	int modelYlen;
-	int modelZlen;
-	double *noise;
-	double *pixels;
-	double color[3] = {0, 0, 0};
+	int modulate;
+	PyObject *result = NULL;
 
-    if (!PyArg_ParseTuple(args, "fOOOddiO|(ddd):render", &zoom,
+	if (!PyArg_ParseTuple(args, "fOOOddiO!|(ddd):render", &zoom,
 			&py_modelX, &py_modelY, &py_modelZ,
-			&time, &time_const, &octaves, &py_frame,
-            &color[0], &color[1], &color[2]
-            ))
-        return NULL;
+			&time, &time_const, &octaves, &PyArray_Type, &frame,
+			&color[0], &color[1], &color[2]
+			))
+		return NULL;
+
+	if (!IS_FLOAT_ARRAY(frame) || !PyArray_IS_C_CONTIGUOUS(frame) ||
+			!PyArray_ISWRITEABLE(frame) || PyArray_NDIM(frame) != 2 || PyArray_DIM(frame, 1) != 3) {
+		PyErr_SetString(PyExc_TypeError, "frame must be a writeable, contiguous (N, 3) float64 or float32 array");
+		return NULL;
+	}
 
-	z0 = fmod(time * time_const, 1024.0f);
+	if (!(modelX = as_double_array(py_modelX, "modelX")) ||
+			!(modelY = as_double_array(py_modelY, "modelY")) ||
+			!(modelZ = as_double_array(py_modelZ, "modelZ")))
+		goto done;
 
-    if (!PySequence_Check(py_modelX)) {
-        PyErr_SetString(PyExc_TypeError, "modelX is not a sequence object");
-        return NULL;
-    }
-
-    if (!PySequence_Check(py_modelY)) {
-        PyErr_SetString(PyExc_TypeError, "modelY is not a sequence object");
-        return NULL;
-    }
-
-    if (!PySequence_Check(py_modelZ)) {
-        PyErr_SetString(PyExc_TypeError, "modelZ is not a sequence object");
-        return NULL;
-    }
-
-    if (!PySequence_Check(py_frame)) {
-        PyErr_SetString(PyExc_TypeError, "frame is not a sequence object");
-        return NULL;
-    }
-
-    modelXlen = (int) PySequence_Length(py_modelX);
-    modelYlen = (int) PySequence_Length(py_modelY);
-    modelZlen = (int) PySequence_Length(py_modelZ);
-	framelen = (int) PySequence_Length(py_frame);
-
-    modelXarray = (PyArrayObject*)PyArray_FROM_OTF(py_modelX, NPY_NOTYPE, 0);
-    modelYarray = (PyArrayObject*)PyArray_FROM_OTF(py_modelY, NPY_DOUBLE, 0);
-    modelZarray = (PyArrayObject*)PyArray_FROM_OTF(py_modelZ, NPY_DOUBLE, 0);
-	pixelarray = (PyArrayObject*)PyArray_FROM_OTF(py_frame, NPY_DOUBLE,
-		NPY_ARRAY_INOUT_ARRAY | NPY_ARRAY_C_CONTIGUOUS | NPY_ARRAY_WRITEABLE |  NPY_ARRAY_UPDATEIFCOPY);
-    
-        modelX = (double *) PyArray_DATA(modelXarray);
-        modelY = (double *) PyArray_DATA(modelYarray);
-        modelZ = (double *) PyArray_DATA(modelZarray);
-        pixels = (double *) PyArray_DATA(pixelarray);
-	if (modelXlen != modelYlen || modelYlen != modelZlen){
-		printf("lens are %d, %d, %d\n", modelXlen, modelYlen, modelZlen);
-        PyErr_SetString(PyExc_ValueError, "edgeCenters are not the same length");
-        return NULL;
+	count = PyArray_DIM(modelX, 0);
+	if (PyArray_DIM(modelY, 0) != count || PyArray_DIM(modelZ, 0) != count) {
+		PyErr_SetString(PyExc_ValueError, "edgeCenters are not the same length");
+		goto done;
 	}
+	if (PyArray_DIM(frame, 0) < count)
+		count = PyArray_DIM(frame, 0);
 
-    scaledX = PyMem_Malloc(modelXlen * sizeof(double));
-	if (scaledX == NULL){  goto dealloc_scaledX; }
-    scaledY = PyMem_Malloc(modelYlen * sizeof(double));
-	if (scaledY == NULL){  goto dealloc_scaledY; }
-    scaledZ = PyMem_Malloc(modelZlen * sizeof(double));
-	if (scaledZ == NULL){  goto dealloc_scaledZ; }
+	x = (const double *) PyArray_DATA(modelX);
+	y = (const double *) PyArray_DATA(modelY);
+	z = (const double *) PyArray_DATA(modelZ);
+	z0 = fmod(time * time_const, 1024.0f);
+	modulate = color[0] == 0 && color[1] == 0 && color[2] == 0;
 
+	Py_BEGIN_ALLOW_THREADS
+	if (PyArray_TYPE(frame) == NPY_FLOAT)
+		APPLY_NOISE(float)
+	else
+		APPLY_NOISE(double)
+	Py_END_ALLOW_THREADS
+
+	Py_INCREF(Py_None);
+	result = Py_None;
+
+done:
+	Py_XDECREF(modelX);
+	Py_XDECREF(modelY);
+	Py_XDECREF(modelZ);
+	return result;
+}
 
-    noise = PyMem_Malloc(modelXlen * sizeof(double));
-	if (noise == NULL){
-        PyErr_SetString(PyExc_ValueError, "failed to alloc noise");
-		return PyErr_NoMemory();
+static PyObject* py_fractal_noise(PyObject* self, PyObject* args)
+{
+	// values from python
+	PyArrayObject *points, *offsets, *out;
+	int octaves;
+	int threads = 1;
+
+	// internal values
+	const double *x, *y, *z, *z0;
+	double *noise;
+	float *noise32;
+	npy_intp count, steps, i;
+
+	if (!PyArg_ParseTuple(args, "O!O!iO!|i:fractal_noise",
+			&PyArray_Type, &points, &PyArray_Type, &offsets, &octaves,
+			&PyArray_Type, &out, &threads))
+		return NULL;
+
+	if (PyArray_TYPE(points) != NPY_DOUBLE || !PyArray_IS_C_CONTIGUOUS(points) ||
+			PyArray_NDIM(points) != 2 || PyArray_DIM(points, 0) != 3) {
+		PyErr_SetString(PyExc_TypeError, "points must be a contiguous (3, N) float64 array");
+		return NULL;
 	}
-	for (i=0; i<modelXlen; ++i){
-		scaledX[i] = modelX[i] * zoom;
-		scaledY[i] = modelY[i] * zoom;
-		scaledZ[i] = modelZ[i] * zoom;
+	if (PyArray_TYPE(offsets) != NPY_DOUBLE || !PyArray_IS_C_CONTIGUOUS(offsets) ||
+			PyArray_NDIM(offsets) != 1) {
+		PyErr_SetString(PyExc_TypeError, "offsets must be a contiguous one-dimensional float64 array");
+		return NULL;
 	}
-
-	Py_DECREF(modelXarray);
-	Py_DECREF(modelYarray);
-	Py_DECREF(modelZarray);
-    Py_DECREF(pixelarray);
-        Py_DECREF(modelX);
-        Py_DECREF(modelY);
-        Py_DECREF(modelZ);
-        Py_DECREF(pixels);
-
-	for(i=0; i<modelXlen; ++i) {
-		noise[i] = make_noise(scaledX[i], scaledY[i], scaledZ[i]+z0, octaves);
+	count = PyArray_DIM(points, 1);
+	steps = PyArray_DIM(offsets, 0);
+	if (!IS_FLOAT_ARRAY(out) || !PyArray_IS_C_CONTIGUOUS(out) || !PyArray_ISWRITEABLE(out) ||
+			PyArray_NDIM(out) != 2 || PyArray_DIM(out, 0) != steps || PyArray_DIM(out, 1) != count) {
+		PyErr_SetString(PyExc_TypeError, "out must be a writeable, contiguous (len(offsets), N) float64 or float32 array");
+		return NULL;
 	}
 
-	for(i=0; i<modelXlen ; ++i) {
-		noise[i] = 1.2f*noise[i] + (1.2f*0.35f);
+	x = (const double *) PyArray_DATA(points);
+	y = x + count;
+	z = y + count;
+	z0 = (const double *) PyArray_DATA(offsets);
+	noise = PyArray_TYPE(out) == NPY_DOUBLE ? (double *) PyArray_DATA(out) : NULL;
+	noise32 = PyArray_TYPE(out) == NPY_FLOAT ? (float *) PyArray_DATA(out) : NULL;
+
+	Py_BEGIN_ALLOW_THREADS
+#ifdef _OPENMP
+	#pragma omp parallel for num_threads(threads > 0 ? threads : 1) schedule(static)
+#endif
+	for (i = 0; i < steps * count; ++i) {
+		npy_intp point = i % count;
+		double n = make_noise(x[point], y[point], z[point] + z0[i / count], octaves);
+		if (noise)
+			noise[i] = n;
+		else
+			noise32[i] = (float) n;
 	}
-	if ( !(color[0] == 0 && color[1] == 0 && color[2] == 0) )
-		for(i=0; i<framelen; ++i) {
-			pixels[3*i] += noise[i] * color[0];
-			pixels[3*i+1] += noise[i] * color[1];
-			pixels[3*i+2] += noise[i] * color[2];
-		}
-	else
-		for(i=0; i<framelen; ++i) {
-			pixels[3*i] *= noise[i];
-			pixels[3*i+1] *= noise[i];
-			pixels[3*i+2] *= noise[i];
-		}
-    PyMem_Free(noise);
-    PyMem_Free(scaledX);
-    PyMem_Free(scaledY);
-    PyMem_Free(scaledZ);
-    Py_RETURN_NONE;
-
-dealloc_scaledZ:
-    PyMem_Free(scaledZ);
-dealloc_scaledY:
-    PyMem_Free(scaledY);
-dealloc_scaledX:
-    PyMem_Free(scaledX);
-	return PyErr_NoMemory();
+	Py_END_ALLOW_THREADS
+
+	Py_RETURN_NONE;
 }
 
 static PyMethodDef methods[] = {
-   { "render", (PyCFunction)py_render, METH_VARARGS,
-    },
-    {NULL}  /* Sentinel */
+	{ "render", (PyCFunction)py_render, METH_VARARGS,
+	  "render(zoom, x, y, z, time, time_const, octaves, frame[, color])\n\n"
+	  "Modulate a (N, 3) float64 or float32 frame by plasma noise sampled at the given coordinates,\n"
+	  "or add the noise in 'color'." },
+	{ "fractal_noise", (PyCFunction)py_fractal_noise, METH_VARARGS,
+	  "fractal_noise(points, offsets, octaves, out[, threads])\n\n"
+	  "Evaluate fractal noise at many points for many time steps in one call. 'points' is\n"
+	  "a contiguous (3, N) array of already scaled x, y and z rows, 'offsets' the z offset\n"
+	  "for each time step, and 'out' a (len(offsets), N) array for the results, in [-1, 1].\n"
+	  "Runs without the GIL, and on 'threads' OpenMP threads if built with OpenMP." },
+	{NULL}  /* Sentinel */
 };
 
+#if PY_MAJOR_VERSION >= 3
+
+static struct PyModuleDef moduledef = {
+	PyModuleDef_HEAD_INIT, "cplasma", "Quicker plasma color effect done in C.", -1, methods
+};
+
+PyMODINIT_FUNC PyInit_cplasma(void)
+{
+	PyObject *m = PyModule_Create(&moduledef);
+	if (m == NULL)
+		return NULL;
+	import_array();
+	return m;
+}
+
+#else
 
 PyMODINIT_FUNC initcplasma(void)
 {
-    Py_InitModule3("cplasma", methods,
-                   "Quicker plasma color effect done in C.");
-	assert(m != NULL);
+	PyObject *m = Py_InitModule3("cplasma", methods,
+				"Quicker plasma color effect done in C.");
+	if (m == NULL)
+		return;
 	import_array();
-	return;
 }
 
+#endif
+
 
 // Copied from source of python noise module
 #define lerp(t, a, b) ((a) + (t) * ((b) - (a)))
 
-float inline
+static inline float
 grad3(const int hash, const float x, const float y, const float z)
 {
 	const int h = hash & 15;
 	return x * GRAD3[h][0] + y * GRAD3[h][1] + z * GRAD3[h][2];
 }
 
-float
+static float
 noise3(float x, float y, float z, const int repeatx, const int repeaty, const int repeatz,
 	const int base)
 {
@@ -249,4 +301,3 @@ noise3(float x, float y, float z, const int repeatx, const int repeaty, const in
 							 lerp(fx, grad3(PERM[AB + kk], x, y - 1, z - 1),
 									  grad3(PERM[BB + kk], x - 1, y - 1, z - 1))));
 }
-
@@ -4,11 +4,15 @@ import random
 from base import EffectLayer, HeadsetResponsiveEffectLayer
 
 class DigitalRainLayer(EffectLayer):
-    """Sort of look like The Matrix"""
+    """Sort of look like The Matrix. With geodesic=True, the rain follows distance along
+       the branches rather than straight-line distance from the base.
+       """
 
     transitionFadeTime = 5
+    additive = True
 
-    def __init__(self):
+    def __init__(self, geodesic=False):
+        self.geodesic = geodesic
         self.tree_count = 6
         self.period = math.pi * 2
         self.maxoffset = self.period
@@ -41,7 +45,10 @@ class DigitalRainLayer(EffectLayer):
     def render(self, model, params, frame):
 
         # Scalar animation parameter, based on height and distance
-        d = model.edgeCenters[:,2] + 0.5 * model.edgeDistances
+        if self.geodesic:
+            d = model.edgeCenters[:,2] + 0.5 * model.edgeGeodesicDistances
+        else:
+            d = model.edgeCenters[:,2] + 0.5 * model.edgeDistances
         numpy.multiply(d, 1/self.height, d)
 
         # Add global offset for Z scrolling over time
@@ -17,6 +17,7 @@ class ColorDrifterLayer(EffectLayer):
     # Number of fade steps to precalculate. Could go
     # higher at additional memory cost, but assuming 8-bit output this is probably OK.    
     fadeSteps = 255
+    additive = True
     
     def __init__(self, colors):
         l = len(colors)
@@ -115,6 +116,8 @@ class OutwardColorDrifterLayer(TimedColorDrifterLayer):
 class ResponsiveColorDrifterLayer(HeadsetResponsiveEffectLayer):
     """ Drifts between two colors depending on headset response level
     (0 = 100% color 1, 1 = 100% color 2)"""
+    additive = True
+
     def __init__(self, colors, respond_to = 'meditation', smooth_response_over_n_secs=1):
         super(ResponsiveColorDrifterLayer,self).__init__(respond_to, smooth_response_over_n_secs)
         if len(colors) != 2:
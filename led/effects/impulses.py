@@ -2,6 +2,7 @@ import colorsys
 import numpy
 import random
 from base import EffectLayer, HeadsetResponsiveEffectLayer
+from led.model import Adjacency
 
 
 class ImpulsesLayer(EffectLayer):
@@ -41,15 +42,72 @@ class ImpulsesLayer(EffectLayer):
 
                         
                         
+class Pulses(object):
+    """All the impulses of one layer, stored as parallel arrays with one entry per pulse:
+       the edge it's on, the previous edge, which end of the edge it's heading for, its
+       motion state, its color and whether it's still alive. Moving, reaping and drawing
+       are then a few numpy operations regardless of the number of pulses.
+       """
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.edge = numpy.zeros(capacity, dtype=numpy.int32)
+        self.previous_edge = numpy.zeros(capacity, dtype=numpy.int32)
+        self.far_end = numpy.zeros(capacity, dtype=numpy.int8)
+        self.motion = numpy.zeros(capacity, dtype=numpy.int8)
+        self.color = numpy.zeros((capacity, 3))
+        self.alive = numpy.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return self.count
+
+    def _grow(self, capacity):
+        for name in ('edge', 'previous_edge', 'far_end', 'motion', 'color', 'alive'):
+            old = getattr(self, name)
+            new = numpy.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def add(self, edges, colors, far_end=0, motion=0):
+        """Add pulses on an array of edges, with one color per pulse (or one for all)."""
+        n = len(edges)
+        if self.count + n > len(self.edge):
+            self._grow(max(2 * len(self.edge), self.count + n))
+        new = slice(self.count, self.count + n)
+        self.edge[new] = edges
+        self.previous_edge[new] = -1
+        self.far_end[new] = far_end
+        self.motion[new] = motion
+        self.color[new] = colors
+        self.alive[new] = True
+        self.count += n
+
+    def reap(self):
+        """Drop the dead pulses, keeping the rest in order."""
+        keep = numpy.flatnonzero(self.alive[:self.count])
+        n = len(keep)
+        if n == self.count:
+            return
+        for array in (self.edge, self.previous_edge, self.far_end, self.motion, self.color, self.alive):
+            array[:n] = array[keep]
+        self.count = n
+
+    def render(self, frame):
+        # add.at, unlike +=, accumulates pulses which share an edge
+        numpy.add.at(frame, self.edge[:self.count], self.color[:self.count])
+
+
 class ImpulseBaseLayer(HeadsetResponsiveEffectLayer):
     """ Base class for layers where impulses fly around the brain. Handles
-    moving, reaping and rendering logic. """
+    moving, reaping and rendering logic. Subclasses implement _move_all() and
+    _spawn_pulses() in terms of the arrays in self.pulses. """
     def __init__(self, respond_to = 'attention', maximum_pulse_count = 40,
                  smooth_response_over_n_secs=0):
         super(ImpulseBaseLayer,self).__init__(respond_to,
             smooth_response_over_n_secs=smooth_response_over_n_secs)
-        self.pulses = []
+        self.pulses = Pulses()
         self.maximum_pulse_count = maximum_pulse_count
+        self.full_pulse_count = maximum_pulse_count
         self.last_time = None
 
         # these are adjustable
@@ -66,16 +124,17 @@ class ImpulseBaseLayer(HeadsetResponsiveEffectLayer):
             return
         self.last_time = params.time
 
-        for pulse in self.pulses:
-            pulse.move(model, params)
+        if len(self.pulses):
+            self._move_all(model, numpy.arange(len(self.pulses)))
 
         self._reap_pulses(model, params)
         self._spawn_pulses(model, params)
 
+    def _move_all(self, model, pulses):
+        raise NotImplementedError("Implement _move_all in child class")
+
     def _reap_pulses(self, model, params):
-        for i in reversed(range(len(self.pulses))):
-            if self.pulses[i].dead:
-                del(self.pulses[i])
+        self.pulses.reap()
                 
     def _get_color(self):
         if self.maxColorSaturation:
@@ -90,118 +149,130 @@ class ImpulseBaseLayer(HeadsetResponsiveEffectLayer):
     def _spawn_pulses(self, model, params):
         raise NotImplementedError("Implement _spawn_pulses in child class")
 
+    def set_quality(self, quality):
+        # Fewer pulses in flight
+        self.quality = quality
+        self.maximum_pulse_count = max(1, int(self.full_pulse_count * quality))
+        return True
+
     def render_responsive(self, model, params, frame, response_level):
         if response_level != None:
             self.spawnChance = response_level * 0.9 # gets much more intense
             self.maxColorSaturation = response_level * 0.50 # gets a little more colory
 
         self._move_pulses(model, params)
-        for pulse in self.pulses:
-            pulse.render(model, params, frame)
+        self.pulses.render(frame)
+
+
+def _far_ends(model, from_edges, to_edges):
+    """For pulses moving from one edge to the next, which end of the new edge (0 or 1 in
+       model.edgeNodes) is the one they're heading for: the end not shared with the old edge.
+       """
+    first = model.edgeNodes[to_edges, 0]
+    shared = (first == model.edgeNodes[from_edges, 0]) | (first == model.edgeNodes[from_edges, 1])
+    return shared.astype(numpy.int8)
+
 
-            
 class ImpulseLayer2(ImpulseBaseLayer):
-    class Impulse():
-        def __init__(self, color, edge, motion = "Out"):
-            self.color = color
-            self.edge = edge
-            self.previous_edge = None
-            self.dead = False
-            self.motion = "Out"
-
-            self.loopChance = 0.1
-            self.bounceChance = 0.2
-
-        def _move_to_any_of(self, edges):
-            self.previous_edge = self.edge
-            self.edge = random.choice(edges)
-
-        def _node_incoming_and_outgoing(self, model):
-            nodes = model.edges[self.edge]
-            previous_nodes = model.edges[self.previous_edge]
-            from_node = (n for n in nodes if n in previous_nodes).next()
-            to_node = (n for n in nodes if n != from_node).next()
-            return (from_node, to_node)
-
-        def _maybe_loop(self, height):
-            if random.random() < self.loopChance:
-                if self.motion == 'Out' and height == 4:
-                    self.motion = 'Loop'
-                elif self.motion == 'In' and height == 5:
-                    self.motion = 'Loop'
-                elif self.motion == 'Loop' and height == 5:
-                    self.motion = 'Out'
-                elif self.motion == 'Loop' and height == 4:
-                    self.motion = 'In'
-
-        def _maybe_bounce(self, model, params):
-            if random.random() < self.bounceChance:
-                if self.motion == 'Out':
-                    self.motion = 'In'
-                    self.move(model, params)
-                elif self.motion == 'In':
-                    self.motion = 'Out'
-                    self.move(model, params)
-                else:
-                    print "Broken"
-                    self.dead = True
-                return True
-
-        def _loop_edges(self, to_edges, model):
-            in_node, out_node = self._node_incoming_and_outgoing(model)
-            out_edges = (e for e in model.edgeListForNodes[out_node] if e != self.edge)
-            return [ e for e in out_edges if model.addressMatchesAnyP(model.addressForEdge[e], ["*.*.*.*.*", "*.*.*.*.1.2", "*.*.*.*.2.1"]) ]
-
-        def _possible_moves(self, model, height):
-            to_edges = model.edgeAdjacency[self.edge]
-            if self.motion == 'Loop':
-                return self._loop_edges(to_edges, model)
-            elif self.motion == 'Out':
-                return [ e for e in to_edges if model.edgeHeight[e] > height ]
-            elif self.motion == 'In':
-                return [ e for e in to_edges if model.edgeHeight[e] < height ]
-
-        def move(self, model, params):
-            height = model.edgeHeight[self.edge]
-            self._maybe_loop(height)
-
-            to_edges = self._possible_moves(model, height)
-
-            if to_edges:
-                self._move_to_any_of(to_edges)
-            else:
-                if not self._maybe_bounce(model, params):
-                    self.dead = True
+    """Impulses which travel out from the roots, sometimes bouncing back in, or looping
+       around the top levels of the tree.
+       """
+
+    # Motion states
+    OUT, IN, LOOP = range(3)
+
+    # Edges a looping impulse may move on to
+    loopPatterns = ("*.*.*.*.*", "*.*.*.*.1.2", "*.*.*.*.2.1")
+
+    loopChance = 0.1
+    bounceChance = 0.2
+
+    def __init__(self, *args, **kwargs):
+        super(ImpulseLayer2, self).__init__(*args, **kwargs)
+        self.modelCache = None
+
+    def _build_tables(self, model):
+        """Precompute, per model, everywhere a pulse can go next. Rows of self.moves are
+           numbered (motion * numLEDs + edge) * 2 + far_end, so one randomNeighbors() call
+           moves every pulse whatever state it's in.
+           """
+        self.modelCache = model
+        loopable = model.addressMask(self.loopPatterns)
+        rows = []
+        for motion in (self.OUT, self.IN, self.LOOP):
+            for edge, adjacent in enumerate(model.edgeAdjacencyCSR.lists()):
+                height = model.edgeHeight[edge]
+                for far_end in (0, 1):
+                    if motion == self.OUT:
+                        rows.append([ e for e in adjacent if model.edgeHeight[e] > height ])
+                    elif motion == self.IN:
+                        rows.append([ e for e in adjacent if model.edgeHeight[e] < height ])
+                    else:
+                        node = model.edgeNodes[edge, far_end]
+                        rows.append([ e for e in model.edgeListForNodesCSR[node].tolist()
+                                      if e != edge and loopable[e] ])
+        self.moves = Adjacency(rows, model.numLEDs)
+
+        # Motion after a random switch into or out of looping, by current motion and height
+        heights = model.edgeHeight.max() + 1
+        self.loopTransitions = numpy.repeat(numpy.arange(3, dtype=numpy.int8), heights).reshape(3, heights)
+        self.loopTransitions[self.OUT, 4] = self.LOOP
+        self.loopTransitions[self.IN, 5] = self.LOOP
+        self.loopTransitions[self.LOOP, 5] = self.OUT
+        self.loopTransitions[self.LOOP, 4] = self.IN
+
+        # Pulses start out heading for the upper end of their root edge
+        z = numpy.array(model.nodes)[:,2]
+        self.upperEnd = (z[model.edgeNodes[:,1]] > z[model.edgeNodes[:,0]]).astype(numpy.int8)
+
+    def _move_all(self, model, pulses):
+        p = self.pulses
+        edges = p.edge[pulses]
+
+        # Maybe start or stop looping
+        motion = p.motion[pulses]
+        switch = numpy.random.random_sample(len(pulses)) < self.loopChance
+        motion[switch] = self.loopTransitions[motion[switch], model.edgeHeight[edges[switch]]]
+        p.motion[pulses] = motion
+
+        to_edges = self.moves.randomNeighbors(
+            (motion.astype(numpy.int32) * model.numLEDs + edges) * 2 + p.far_end[pulses])
+
+        moving = to_edges >= 0
+        moved, to_edges = pulses[moving], to_edges[moving]
+        p.far_end[moved] = _far_ends(model, edges[moving], to_edges)
+        p.previous_edge[moved] = edges[moving]
+        p.edge[moved] = to_edges
+
+        # Nowhere to go. Maybe bounce back the way we came, otherwise die. Looping pulses
+        # can't bounce.
+        stuck = pulses[~moving]
+        bounce = (numpy.random.random_sample(len(stuck)) < self.bounceChance) & (p.motion[stuck] != self.LOOP)
+        p.alive[stuck[~bounce]] = False
+        bounced = stuck[bounce]
+        if len(bounced):
+            p.motion[bounced] = numpy.where(p.motion[bounced] == self.OUT, self.IN, self.OUT)
+            self._move_all(model, bounced)
+
+    def prepare(self, model):
+        if model is not self.modelCache:
+            self._build_tables(model)
 
-        def render(self, model, params, frame):
-            numpy.add( frame[self.edge], self.color, frame[self.edge] )
+    def render_responsive(self, model, params, frame, response_level):
+        self.prepare(model)
+        super(ImpulseLayer2, self).render_responsive(model, params, frame, response_level)
 
     def _spawn_pulses(self, model, params):
-        while True:
-            if len(self.pulses) >= self.maximum_pulse_count:
-                return
-            if random.random() > self.spawnChance:
-                return
-            color = self._get_color()
-            self.pulses.append(ImpulseLayer2.Impulse(color, random.choice(model.roots)))
+        count = 0
+        while len(self.pulses) + count < self.maximum_pulse_count and random.random() <= self.spawnChance:
+            count += 1
+        if count:
+            roots = numpy.random.choice(model.roots, count)
+            colors = [self._get_color() for i in range(count)]
+            self.pulses.add(roots, colors, self.upperEnd[roots], self.OUT)
 
 class UpwardImpulseLayer(ImpulseBaseLayer):
     """Just stream impulses up the trees at a regular frequency. """
-    class UpwardImpulse():
-        def __init__(self, color, edge):
-            self.color = color
-            self.edge = edge
-            self.dead = False
-            
-        def move(self, model, params):
-            if len(model.outwardAdjacency[self.edge]) > 0:
-                self.previous_edge = self.edge
-                self.edge = random.choice(model.outwardAdjacency[self.edge])
-            else:
-                self.dead = True
-                
-        def render(self, model, params, frame):
-            numpy.add( frame[self.edge], self.color, frame[self.edge] )
             
     # default "alternating" mode cycles through the trees when spawning impulses. 'all' mode spawns
     # on all trees at once, and is currently a bit crazy/not ready to use.
@@ -212,20 +283,31 @@ class UpwardImpulseLayer(ImpulseBaseLayer):
         self.base_frequency = self.frequency
         self.max_frequency = self.base_frequency*3
         self.color = numpy.repeat(self.brightness, 3) # keeping this one all white to help differentiate it
+
+    def _move_all(self, model, pulses):
+        p = self.pulses
+        to_edges = model.outwardAdjacencyCSR.randomNeighbors(p.edge[pulses])
+        moving = to_edges >= 0
+        p.previous_edge[pulses[moving]] = p.edge[pulses[moving]]
+        p.edge[pulses[moving]] = to_edges[moving]
+        # End of the line
+        p.alive[pulses[~moving]] = False
             
     def _spawn_pulses(self, model, params):
         if not hasattr(self,'last'):
             self.last = 0
+        # Only the quality governor's reduced levels cap these; at full quality they stream freely
+        if self.quality < 1 and len(self.pulses) >= self.maximum_pulse_count:
+            return
         
         root = (self.last+1)%len(model.roots)
         color = self._get_color()
 
         if self.mode == 'alternating':
-            self.pulses.append(UpwardImpulseLayer.UpwardImpulse(color, model.roots[root]))
+            self.pulses.add(model.roots[root:root+1], color)
             self.last = root
         else:
-            for r in model.roots:
-                self.pulses.append(UpwardImpulseLayer.UpwardImpulse(color, r))
+            self.pulses.add(model.roots, color)
                 
     def _get_color(self):
         return self.color
@@ -1,63 +1,83 @@
 import math
 import numpy
 import random
+import weakref
 from base import EffectLayer, HeadsetResponsiveEffectLayer
 
 
-class Bolt(object):
-    """Represents a single lightning bolt in the LightningStormLayer effect."""
+class BoltPaths(object):
+    """Every path a lightning bolt can take on a model, worked out once up front.
+
+       A bolt's leader starts at a random root and climbs outward, picking one of the outward
+       edges at random each step, until it runs out of tree. The other outward edges at each
+       step are lit as dimmer side branches. Here we enumerate all such leaders, with the
+       chance of each, as rows of padded arrays: 'edges' and 'intensities' are (paths, length),
+       and padding entries have zero intensity.
+       """
 
     PULSE_INTENSITY = 0.08
-    PULSE_FREQUENCY = 10.
-    FADE_TIME = 0.25
     SECONDARY_BRANCH_INTENSITY = 0.4
 
-    def __init__(self, model, init_time):
-        self.init_time = init_time
-        self.pulse_time = random.uniform(.25, .35)
-        self.color = numpy.array([v/255.0 for v in [230, 230, 255]])  # Violet storm
-        self.life_time = self.pulse_time + Bolt.FADE_TIME
-        self.edges, self.intensities = self.choose_random_path(model)
-
-    def choose_random_path(self, model):
-        leader_intensity = (1.0 - Bolt.PULSE_INTENSITY)
-        branch_intensity = leader_intensity * Bolt.SECONDARY_BRANCH_INTENSITY
-        root = random.choice(model.roots)
-        edges = [root]
-        leader = root
-        intensities = [leader_intensity]
-        while model.outwardAdjacency[leader]:
-            next_leader = random.choice(model.outwardAdjacency[leader])
-            for edge in model.outwardAdjacency[leader]:
-                edges.append(edge)
-                if edge == next_leader:
-                    # Main bolt branch fully bright
-                    intensities.append(leader_intensity)
-                else:
-                    # Partially light clipped branches
-                    intensities.append(branch_intensity)
-            leader = next_leader
-        return numpy.array(edges), numpy.array(intensities)
-
-    def update_frame(self, frame, current_time):
-        dt = current_time - self.init_time
-
-        if dt < self.pulse_time:  # Bolt fully lit and pulsing
-            phase = math.cos(2 * math.pi * dt * Bolt.PULSE_FREQUENCY) 
-            intensities = self.intensities + (phase * Bolt.PULSE_INTENSITY)
-            c = self.color.reshape(1, -1) * intensities.reshape(-1, 1)
-            frame[self.edges] += c
-
-        else:  # Bolt fades out linearly
-            fade = 1 - (dt - self.pulse_time) * 1.0 / Bolt.FADE_TIME
-            intensities = self.intensities * fade
-            c = self.color.reshape(1, -1) * intensities.reshape(-1, 1)
-            frame[self.edges] += c
+    _libraries = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def for_model(cls, model):
+        library = cls._libraries.get(model)
+        if library is None:
+            library = cls._libraries[model] = cls(model)
+        return library
+
+    def __init__(self, model):
+        leader_intensity = (1.0 - BoltPaths.PULSE_INTENSITY)
+        branch_intensity = leader_intensity * BoltPaths.SECONDARY_BRANCH_INTENSITY
+
+        paths = []
+        for root in model.roots:
+            # Depth-first over leaders: (leader edge, lit edges so far, probability so far)
+            stack = [(root, [(root, leader_intensity)], 1.0 / len(model.roots))]
+            while stack:
+                leader, lit, probability = stack.pop()
+                choices = model.outwardAdjacency[leader]
+                if not choices:
+                    paths.append((lit, probability))
+                    continue
+                for next_leader in choices:
+                    step = [(edge, leader_intensity if edge == next_leader else branch_intensity)
+                            for edge in choices]
+                    stack.append((next_leader, lit + step, probability / len(choices)))
+
+        length = max(len(self._unique(lit)) for lit, probability in paths)
+        self.edges = numpy.zeros((len(paths), length), dtype=numpy.int32)
+        self.intensities = numpy.zeros((len(paths), length))
+        self.lit = numpy.zeros((len(paths), length))
+        for i, (lit, probability) in enumerate(paths):
+            lit = self._unique(lit)
+            self.edges[i, :len(lit)] = [edge for edge, intensity in lit]
+            self.intensities[i, :len(lit)] = [intensity for edge, intensity in lit]
+            self.lit[i, :len(lit)] = 1
+        self.cumulative = numpy.cumsum([probability for lit, probability in paths])
+
+    def _unique(self, lit):
+        # If an edge is lit twice along one path, the later intensity wins
+        return dict(lit).items()
+
+    def choose(self, count=1):
+        """Indices of randomly chosen paths, with the same odds as walking the tree."""
+        r = numpy.random.random_sample(count) * self.cumulative[-1]
+        return numpy.searchsorted(self.cumulative, r, side='right').astype(numpy.int32)
 
 
 class LightningStormLayer(HeadsetResponsiveEffectLayer):
     """Simulate lightning storm."""
 
+    PULSE_FREQUENCY = 10.
+    MIN_PULSE_TIME = 0.25
+    MAX_PULSE_TIME = 0.35
+    FADE_TIME = 0.25
+
+    # Cap on simultaneous bolts, only applied at reduced quality
+    maximum_bolts = None
+
     def __init__(self,
                  max_bolts_per_second = 8.0,
                  min_bolts_per_second = 0.5,
@@ -66,7 +86,13 @@ class LightningStormLayer(HeadsetResponsiveEffectLayer):
         # http://www.youtube.com/watch?v=RLWIBrweSU8
         super(LightningStormLayer,self).__init__(
             respond_to, smooth_response_over_n_secs=smooth_response_over_n_secs)
-        self.bolts = []
+        self.color = numpy.array([v/255.0 for v in [230, 230, 255]])  # Violet storm
+
+        # Live bolts: which path each is on, when it struck and how long it pulses for
+        self.bolt_paths = numpy.zeros(0, dtype=numpy.int32)
+        self.bolt_times = numpy.zeros(0)
+        self.bolt_pulse_times = numpy.zeros(0)
+
         self.min_bolts_per_second = min_bolts_per_second
         self.max_bolts_per_second = max_bolts_per_second
         self.span = self.max_bolts_per_second - self.min_bolts_per_second
@@ -74,10 +100,51 @@ class LightningStormLayer(HeadsetResponsiveEffectLayer):
         self.compute_bolts_per_second(0.5)
         self.last_time = None
 
+    def prepare(self, model):
+        BoltPaths.for_model(model)
+
+    def set_quality(self, quality):
+        # At reduced quality, cap the bolts on screen at that fraction of the most we'd see
+        # at our fastest strike rate: the rate times the longest a bolt lasts.
+        if quality >= 1:
+            maximum = None
+        else:
+            busiest = self.max_bolts_per_second * (self.MAX_PULSE_TIME + self.FADE_TIME)
+            maximum = max(1, int(round(busiest * quality)))
+            if quality < self.quality and maximum == self.maximum_bolts:
+                return False
+        self.quality = quality
+        self.maximum_bolts = maximum
+        return True
+
     def compute_bolts_per_second(self, response_level):
         self.bolts_per_second = self.min_bolts_per_second + (
             response_level * response_level * self.span)
 
+    def strike(self, library, time):
+        self.bolt_paths = numpy.append(self.bolt_paths, library.choose())
+        self.bolt_times = numpy.append(self.bolt_times, time)
+        self.bolt_pulse_times = numpy.append(self.bolt_pulse_times, random.uniform(self.MIN_PULSE_TIME, self.MAX_PULSE_TIME))
+
+    def draw_bolts(self, model, library, frame, current_time):
+        dt = current_time - self.bolt_times
+        pulsing = dt < self.bolt_pulse_times
+
+        # Bolts are fully lit and pulsing, then fade out linearly. Either way each bolt's
+        # intensities are scale * path intensity + offset.
+        phase = numpy.cos(2 * math.pi * dt * self.PULSE_FREQUENCY)
+        fade = 1 - (dt - self.bolt_pulse_times) * 1.0 / self.FADE_TIME
+        scale = numpy.where(pulsing, 1.0, fade)
+        offset = numpy.where(pulsing, phase * BoltPaths.PULSE_INTENSITY, 0.0)
+
+        intensities = library.intensities[self.bolt_paths] * scale.reshape(-1, 1)
+        intensities += library.lit[self.bolt_paths] * offset.reshape(-1, 1)
+
+        # Sum all bolts per edge in one go; bolts are allowed to overlap
+        total = numpy.bincount(library.edges[self.bolt_paths].ravel(),
+                               intensities.ravel(), model.numLEDs)
+        frame += total.reshape(-1, 1) * self.color
+
     def render_responsive(self, model, params, frame, response_level):
         if response_level != None:
             self.compute_bolts_per_second(response_level)
@@ -85,8 +152,13 @@ class LightningStormLayer(HeadsetResponsiveEffectLayer):
         if not self.last_time:
             self.last_time = params.time
 
-        self.bolts = [bolt for bolt in self.bolts
-                      if bolt.init_time + bolt.life_time > params.time]
+        alive = self.bolt_times + self.bolt_pulse_times + self.FADE_TIME > params.time
+        if not alive.all():
+            self.bolt_paths = self.bolt_paths[alive]
+            self.bolt_times = self.bolt_times[alive]
+            self.bolt_pulse_times = self.bolt_pulse_times[alive]
+
+        library = BoltPaths.for_model(model)
 
         # Bolts will strike as a poisson arrival process. That is, randomly,
         # but on average, 'bolts_per_second' bolts will strike per second.
@@ -94,9 +166,10 @@ class LightningStormLayer(HeadsetResponsiveEffectLayer):
         # and relative flurry.
         if (params.time - self.last_time) * self.bolts_per_second > random.random():
             # Bolts are allowed to overlap, creates some interesting effects
-            self.bolts.append(Bolt(model, params.time))
+            if self.maximum_bolts is None or len(self.bolt_paths) < self.maximum_bolts:
+                self.strike(library, params.time)
 
         self.last_time = params.time
 
-        for bolt in self.bolts:
-            bolt.update_frame(frame, params.time)
+        if len(self.bolt_paths):
+            self.draw_bolts(model, library, frame, params.time)
@@ -1,17 +1,114 @@
 import math
 import numpy
+import threading
 import cplasma
 from base import EffectLayer, HeadsetResponsiveEffectLayer
 
 
+class NoiseKeyframes(object):
+    """Plasma noise sampled on a coarse time grid, for one set of scaled LED coordinates
+       and octave count. sample() linearly interpolates between the two keyframes around
+       the current time. A background thread keeps the next 'lookahead' keyframes filled,
+       computing them in batches with cplasma.fractal_noise, which runs without the GIL.
+       If a keyframe isn't ready yet, sample() computes it on the spot.
+       """
+
+    def __init__(self, points, octaves, time_const, interval, lookahead=8, threads=1):
+        self.points = points
+        self.octaves = octaves
+        self.time_const = time_const
+        self.interval = interval
+        self.lookahead = lookahead
+        self.threads = threads
+
+        # Ring of keyframes, slot k % len(keys) holds keyframe k if keys says so
+        self.keys = numpy.repeat(-1, lookahead + 2)
+        self.frames = numpy.zeros((len(self.keys), points.shape[1]))
+        self.wanted = None
+        self.running = True
+        self.lock = threading.Condition()
+
+        self.thread = threading.Thread(target=self._fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+
+    def _compute(self, keys):
+        offsets = numpy.fmod(numpy.asarray(keys) * self.interval * self.time_const, 1024.0)
+        noise = numpy.empty((len(keys), self.points.shape[1]))
+        cplasma.fractal_noise(self.points, offsets, self.octaves, noise, self.threads)
+        return noise
+
+    def _store(self, keys, noise):
+        with self.lock:
+            for key, frame in zip(keys, noise):
+                # Don't overwrite keyframes which are still in use
+                if self.wanted is None or key >= self.wanted:
+                    slot = key % len(self.keys)
+                    self.frames[slot] = frame
+                    self.keys[slot] = key
+
+    def _missing(self, first, last):
+        return [ key for key in range(first, last + 1) if self.keys[key % len(self.keys)] != key ]
+
+    def _fill(self):
+        while True:
+            with self.lock:
+                while self.running:
+                    if self.wanted is not None:
+                        missing = self._missing(self.wanted, self.wanted + self.lookahead)
+                        if missing:
+                            break
+                    self.lock.wait()
+                if not self.running:
+                    return
+            self._store(missing, self._compute(missing))
+
+    def sample(self, time, out):
+        """Write interpolated noise for 'time' into 'out', one value per LED."""
+        position = time / self.interval
+        key = int(math.floor(position))
+        with self.lock:
+            if self.wanted != key:
+                self.wanted = key
+                self.lock.notify()
+            missing = self._missing(key, key + 1)
+        if missing:
+            self._store(missing, self._compute(missing))
+
+        with self.lock:
+            before = self.frames[key % len(self.keys)]
+            after = self.frames[(key + 1) % len(self.keys)]
+            numpy.subtract(after, before, out)
+            numpy.multiply(out, position - key, out)
+            numpy.add(out, before, out)
+
+
 class PlasmaLayer(EffectLayer):
     """A plasma cloud layer, implemented with smoothed noise.
 
        If 'color' is None, this modulates the brightness of the framebuffer's
        existing contents. Otherwise, it's a color 3-tuple.
+
+       The LED coordinates, scaled by the zoom, are cached until the model or zoom
+       changes. The noise is evaluated by cplasma.fractal_noise(), on 'threads' threads
+       if cplasma was built with OpenMP. That only pays off for far more LEDs than we
+       have, so it defaults to 1.
+
+       With keyframeInterval set (in seconds), the noise is only evaluated at that
+       interval, ahead of time on a background thread (see NoiseKeyframes), and
+       interpolated in between. The field drifts slowly, so at a few hundredths of a
+       second it looks the same at a fraction of the cost. Changing zoom or octaves starts
+       a new set of keyframes.
        """
 
-    def __init__(self, color=None, zoom=0.6):
+    threads = 1
+
+    def __init__(self, color=None, zoom=0.6, keyframeInterval=None):
         # Noise spatial scale, in number of noise datapoints at the fundamental frequency
         # visible along the length of the sculpture. Larger numbers "zoom out".
         # For perlin noise, we have multiple octaves of detail, so staying zoomed in lets
@@ -25,33 +122,84 @@ class PlasmaLayer(EffectLayer):
         # the noise function seamlessly tiles. By default, this is at 1024 units in the
         # coordinate space used by pnoise3().
         self.octaves = 3
+        self.full_octaves = self.octaves
         
         self.color = None if color is None else numpy.array(color)
         self.time_const = -1.5
         self.modelCache = None
+        self.zoomCache = None
+        self.keyframeInterval = keyframeInterval
+        self.keyframes = None
+
+    def set_quality(self, quality):
+        # Fewer octaves of noise: less fine detail, proportionally less work. Once we're
+        # down to one octave, lower levels save nothing.
+        octaves = max(1, int(round(self.full_octaves * quality)))
+        if quality < self.quality and octaves == self.octaves:
+            return False
+        self.quality = quality
+        self.octaves = octaves
+        return True
 
     def render(self, model, params, frame):
-        if model is not self.modelCache:
+        if (model is not self.modelCache or self.zoom != self.zoomCache or
+                self.noise.dtype != frame.dtype):
             self.modelCache = model
+            self.zoomCache = self.zoom
+            # Rows of x, y and z, as cplasma wants them. Zoom is a float in the C code.
+            self.points = numpy.ascontiguousarray(model.edgeCenters.T * numpy.float32(self.zoom))
+            self.offset = numpy.zeros(1)
+            # Noise in the frame's dtype, so applying it needs no conversions
+            self.noise = numpy.zeros((1, model.numLEDs), frame.dtype)
+            self._stopKeyframes()
+
+        if self.keyframeInterval:
+            if self.keyframes is None or self.keyframes.octaves != self.octaves:
+                self._stopKeyframes()
+                self.keyframes = NoiseKeyframes(self.points, self.octaves, self.time_const,
+                                                self.keyframeInterval, threads=self.threads)
+            self.keyframes.sample(params.time, self.noise[0])
+        else:
+            self.offset[0] = math.fmod(params.time * self.time_const, 1024.0)
+            cplasma.fractal_noise(self.points, self.offset, self.octaves, self.noise, self.threads)
+
+        # Noise to brightness
+        noise = self.noise.reshape(-1, 1)
+        numpy.multiply(noise, 1.2, noise)
+        numpy.add(noise, 1.2 * 0.35, noise)
+
         if self.color is not None:
-            cplasma.render(self.zoom,
-                    self.modelCache.edgeCenters[:,0],
-                    self.modelCache.edgeCenters[:,1],
-                    self.modelCache.edgeCenters[:,2],
-                    params.time, self.time_const, self.octaves, frame, self.color)
+            frame += noise * self.color
         else:
-            cplasma.render(self.zoom,
-                    self.modelCache.edgeCenters[:,0],
-                    self.modelCache.edgeCenters[:,1],
-                    self.modelCache.edgeCenters[:,2],
-                    params.time, self.time_const, self.octaves, frame)
+            frame *= noise
+
+    def _stopKeyframes(self):
+        if self.keyframes is not None:
+            self.keyframes.close()
+            self.keyframes = None
 
 class ZoomingPlasmaLayer(HeadsetResponsiveEffectLayer):
-    def __init__(self, color = None, respond_to = 'meditation'):
+    # With keyframes, the zoom is rounded to this, so a slowly changing headset reading
+    # doesn't throw the keyframes away on every frame.
+    keyframeZoomStep = 0.05
+
+    def __init__(self, color = None, respond_to = 'meditation', keyframeInterval=None):
         super(ZoomingPlasmaLayer,self).__init__(respond_to)
-        self.plasma = PlasmaLayer(color, 0.6)
+        self.plasma = PlasmaLayer(color, 0.6, keyframeInterval)
+
+    def prepare(self, model):
+        self.plasma.prepare(model)
+
+    def set_quality(self, quality):
+        if self.plasma.set_quality(quality) is False:
+            return False
+        self.quality = quality
+        return True
 
     def render_responsive(self, model, params, frame, response_level):
         if response_level:
             self.plasma.zoom = 2.1 - response_level * 2
+            if self.plasma.keyframeInterval:
+                step = self.keyframeZoomStep
+                self.plasma.zoom = round(self.plasma.zoom / step) * step
         self.plasma.render(model, params, frame)
@@ -1,4 +1,3 @@
-import itertools
 import math
 import numpy
 import random
@@ -7,69 +6,100 @@ from base import EffectLayer, HeadsetResponsiveEffectLayer
 class RainLayer(HeadsetResponsiveEffectLayer):
     """
     Raindrop-ish points of light at random places on the model.
+
+    Each drop lights its edge, then a moment later the ring of edges around it, then the
+    next ring out, each dimmer than the last. The drops live in a fixed-size pool of
+    arrays, and their rings come from model.neighborhoods, so all drops are drawn at once.
     """
-    class Raindrop:
-        def __init__(self, model, edge, duration=1, color=(1, 1, 1)):
-            self.first = edge 
-            self.second = model.edgeAdjacency[edge] 
-            self.third = [ model.edgeAdjacency[e] for e in self.second ]
-            self.third = list(itertools.chain(*self.third))
-            self.third = list(set( [e for e in self.third if e is not self.first and e not in self.second] ))
-            
-            self.done = False
-            self.start = None
-            self.color = numpy.array(color)
-            self.duration = duration
-            # lag between when an edge lights up and its adjacent edges do
-            self.delay = float(duration)/12
-            
-        def get_color(self, params, delay=0, attenuate=0):
-            dt = params.time - self.start - delay
-            if dt > 0 and dt < self.duration:
-                return self.color * math.sin(math.pi * 2 * dt / self.duration) * (1.0-attenuate)
-            else:
-                return numpy.array([0,0,0])
-            
-        def render(self, model, params, frame):
-            if not self.start:
-                self.start = params.time
-            if params.time - self.start > self.duration + self.delay:
-                self.done = True
-                
-            if not self.done:
-                # drop propagates out from starting edge, fading as it goes
-                c1 = self.get_color(params)
-                c2 = self.get_color(params, self.delay, 0.6)
-                c3 = self.get_color(params, self.delay*2, 0.8)
-                frame[self.first] = c1
-                if len(self.second) > 0:
-                    frame[self.second] += c2
-                if len(self.third) > 0:
-                    frame[self.third] += c3
-            
-            
-    def __init__(self, respond_to = 'attention', dropEvery=5, inverse=True):
+
+    # Brightness of each ring, starting with the drop's own edge
+    ringBrightness = numpy.array([1.0, 0.4, 0.2])
+
+    def __init__(self, respond_to = 'attention', dropEvery=5, inverse=True, duration=1,
+                 color=(1, 1, 1), maximumDrops=256):
         """ Drop onset times are stochastic but average to one every dropEvery seconds
         when the headset is off or reading 0
         """
         super(RainLayer,self).__init__(respond_to, smooth_response_over_n_secs=1, inverse=inverse)
         self.dropEvery = dropEvery
         self.minDropEvery = dropEvery / 10.0 # how fast it'll go if headset is reading 1
-        self.drops = []
         self.lastTime = None
-        
+        self.duration = duration
+        self.color = numpy.array(color)
+        # lag between when an edge lights up and its adjacent edges do
+        self.delay = float(duration)/12
+
+        # Drop pool. Each drop has a start time, a center edge, and the range of
+        # model.neighborhoods.indices holding its outer rings.
+        self.numDrops = 0
+        self.dropStart = numpy.zeros(maximumDrops)
+        self.dropEdge = numpy.zeros(maximumDrops, dtype=numpy.int32)
+        self.dropRingStart = numpy.zeros(maximumDrops, dtype=numpy.int32)
+        self.dropRingEnd = numpy.zeros(maximumDrops, dtype=numpy.int32)
+
     def getResponsiveInterval(self, response_level):
         if response_level is None:
             return self.dropEvery
         else:
             return self.minDropEvery + (1.0-response_level)*(self.dropEvery-self.minDropEvery)
-        
+
+    def prepare(self, model):
+        # Each ring past the drop's own edge is one more hop of model.neighborhoods
+        if model.neighborhoods.radius < len(self.ringBrightness) - 1:
+            raise ValueError("RainLayer needs a model with neighborhoodRadius of at least %d, not %d"
+                             % (len(self.ringBrightness) - 1, model.neighborhoods.radius))
+
+    def addDrop(self, model, edge, time):
+        if self.numDrops == len(self.dropStart):
+            return
+        self.prepare(model)
+        n = self.numDrops
+        rings = model.neighborhoods.radius + 1
+        self.dropStart[n] = time
+        self.dropEdge[n] = edge
+        self.dropRingStart[n] = model.neighborhoods.indptr[edge * rings + 1]
+        self.dropRingEnd[n] = model.neighborhoods.indptr[edge * rings + len(self.ringBrightness)]
+        self.numDrops += 1
+
+    def removeFinishedDrops(self, time):
+        n = self.numDrops
+        keep = numpy.flatnonzero(time - self.dropStart[:n] <= self.duration + self.delay)
+        if len(keep) < n:
+            for array in (self.dropStart, self.dropEdge, self.dropRingStart, self.dropRingEnd):
+                array[:len(keep)] = array[keep]
+            self.numDrops = len(keep)
+
+    def brightness(self, elapsed, ring):
+        # One full sine period per drop, with each ring starting a little later
+        dt = elapsed - ring * self.delay
+        result = numpy.sin(dt * (math.pi * 2 / self.duration))
+        result *= self.ringBrightness[ring]
+        result[(dt <= 0) | (dt >= self.duration)] = 0
+        return result
+
+    def drawDrops(self, model, params, frame):
+        n = self.numDrops
+        elapsed = params.time - self.dropStart[:n]
+
+        # Gather every drop's outer rings from the neighborhood table, in one flat array
+        starts = self.dropRingStart[:n]
+        lengths = self.dropRingEnd[:n] - starts
+        drop = numpy.repeat(numpy.arange(n), lengths)
+        entries = numpy.arange(lengths.sum()) + numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths)
+        ringEdges = model.neighborhoods.indices[entries]
+        ringBrightness = self.brightness(elapsed[drop], model.neighborhoods.hops[entries])
+
+        # Each drop's own edge is set outright, then the rings are added on top
+        frame[self.dropEdge[:n]] = self.brightness(elapsed, 0).reshape(-1, 1) * self.color
+        rings = numpy.bincount(ringEdges, ringBrightness, model.numLEDs)
+        frame += rings.reshape(-1, 1) * self.color
+
     def render_responsive(self, model, params, frame, response_level):
         if not self.lastTime:
             self.lastTime = params.time
-        self.drops = [ d for d in self.drops if not d.done ]
+        self.removeFinishedDrops(params.time)
         if (params.time - self.lastTime) / self.getResponsiveInterval(response_level) > random.random():
-            self.drops.append( RainLayer.Raindrop(model, random.randint(0, model.numLEDs-1)) )
+            self.addDrop(model, random.randint(0, model.numLEDs-1), params.time)
             self.lastTime = params.time
-        for d in self.drops:
-            d.render(model, params, frame)
+        if self.numDrops:
+            self.drawDrops(model, params, frame)
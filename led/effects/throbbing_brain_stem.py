@@ -1,12 +1,19 @@
 import numpy
 from base import EffectLayer, HeadsetResponsiveEffectLayer
+from waves import WavesLayer
 
 class ThrobbingBrainStemLayer(WavesLayer):
     """ Child of WavesLayer with different speed parameters whose wave only goes a
     certain number of levels up the tree (and is linearly attenuated as it moves up).
     Currently doesn't add any new headset-responsivity, but later we could potentially
     make it change the number of levels or the attenuation.
+
+    Unlike WavesLayer it isn't additive: the wave is attenuated in place, so in 'add'
+    mode the Compositor gives it a blank frame of its own and adds that to the frame.
     """
+    additive = False
+    blendMode = 'add'
+
     def __init__(self, levels=6, period=1, speed=2.5, color=(0.5, 0, 1), respond_to='attention'):
         super(ThrobbingBrainStemLayer, self).__init__(color=color, period=period, speed=speed, respond_to=respond_to)
         self.levels = levels
@@ -23,6 +30,5 @@ class ThrobbingBrainStemLayer(WavesLayer):
             normedHeights[normedHeights < 0] = 0
             self.scaleFactors = normedHeights.repeat(3).reshape(model.numLEDs,3)
         
-        temp = numpy.zeros(frame.shape)
-        super(ThrobbingBrainStemLayer, self).render(model, params, temp)
-        frame += temp * self.scaleFactors
+        super(ThrobbingBrainStemLayer, self).render(model, params, frame)
+        numpy.multiply(frame, self.scaleFactors, frame)
@@ -4,13 +4,18 @@ from base import EffectLayer, HeadsetResponsiveEffectLayer
 
 
 class WavesLayer(HeadsetResponsiveEffectLayer):
-    """Occasional wavefronts of light which propagate outward from the base of the tree"""
+    """Occasional wavefronts of light which propagate outward from the base of the tree.
+       With geodesic=True the waves travel along the branches instead of outward through
+       space, so they reach the tips of long branches last.
+       """
 
     width = 0.4
     minimum_period = -1 # anything less than pi/2 is just as-fast-as-possible
+    additive = True
 
-    def __init__(self, color=(0.5, 0.5, 1), period=5.0, speed=1.5, respond_to='meditation', smooth_response_over_n_secs=0, inverse=False):
+    def __init__(self, color=(0.5, 0.5, 1), period=5.0, speed=1.5, respond_to='meditation', smooth_response_over_n_secs=0, inverse=False, geodesic=False):
         super(WavesLayer,self).__init__(respond_to, smooth_response_over_n_secs, inverse=inverse)
+        self.geodesic = geodesic
         self.wave_started_at = 0
         self.drawing_wave = False
         self.color = numpy.array(color)
@@ -26,7 +31,10 @@ class WavesLayer(HeadsetResponsiveEffectLayer):
         if center < math.pi/2:
             self.drawing_wave = True
             # Calculate each pixel's position within the pulse, in radians
-            a = model.edgeDistances - center
+            if self.geodesic:
+                a = model.edgeGeodesicDistances - center
+            else:
+                a = model.edgeDistances - center
             numpy.abs(a, a)
             numpy.multiply(a, math.pi/2 / self.width, a)
 
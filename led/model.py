@@ -1,8 +1,121 @@
 #!/usr/bin/env python
 
+import hashlib
+import itertools
 import json
 import math
 import numpy
+import os
+import scipy.sparse
+import scipy.sparse.csgraph
+import sys
+
+
+class Adjacency(object):
+    """Adjacency lists in compressed sparse row (CSR) form. The neighbors of item i are
+       indices[indptr[i]:indptr[i+1]]. Both arrays are int32, so whole sets of lookups can
+       be done with numpy instead of Python loops.
+       """
+
+    def __init__(self, lists, numColumns=None):
+        self.indptr = numpy.zeros(len(lists) + 1, dtype=numpy.int32)
+        self.indptr[1:] = numpy.cumsum([len(l) for l in lists])
+        self.indices = numpy.array(list(itertools.chain(*lists)), dtype=numpy.int32)
+        self.degree = numpy.diff(self.indptr)
+        self.numColumns = len(lists) if numColumns is None else numColumns
+
+    @classmethod
+    def fromArrays(cls, indptr, indices, numColumns):
+        self = cls.__new__(cls)
+        self.indptr = indptr
+        self.indices = indices
+        self.degree = numpy.diff(indptr)
+        self.numColumns = numColumns
+        return self
+
+    def lists(self):
+        """Back to a list of Python lists."""
+        indices = self.indices.tolist()
+        return [indices[start:end] for start, end in zip(self.indptr[:-1], self.indptr[1:])]
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def randomNeighbors(self, items):
+        """Pick one neighbor at random for each of an array of items, all at once. Items
+           with no neighbors get -1.
+           """
+        degree = self.degree[items]
+        picks = self.indptr[items] + (numpy.random.random_sample(len(items)) * degree).astype(numpy.int32)
+        result = numpy.full(len(items), -1, dtype=numpy.int32)
+        hasNeighbors = degree > 0
+        result[hasNeighbors] = self.indices[picks[hasNeighbors]]
+        return result
+
+    def matrix(self):
+        """Sparse 0/1 matrix with a 1 at (i, j) for every neighbor j of i. Multiplying it
+           by a vector of per-item values sums the values of each item's neighbors.
+           """
+        return scipy.sparse.csr_matrix(
+            (numpy.ones(len(self.indices)), self.indices, self.indptr),
+            shape=(len(self), self.numColumns))
+
+
+class Neighborhoods(object):
+    """Every edge's neighbors, grouped into rings by hop count, out to a fixed radius.
+       Ring 0 is the edge itself, ring 1 its adjacent edges, ring 2 the edges adjacent to
+       those which aren't in an earlier ring, and so on.
+
+       All rings live in one flat int32 'indices' array. An edge's rings are stored one after
+       another, so ring(e, k) and within(e, k) are both a single slice. 'hops' parallels
+       'indices' with the ring number of each entry.
+       """
+
+    def __init__(self, adjacency, radius):
+        rings = []
+        for edge in range(len(adjacency)):
+            seen = set([edge])
+            ring = [edge]
+            rings.append(ring)
+            for hop in range(radius):
+                ring = sorted(set(n for e in ring for n in adjacency[e].tolist()) - seen)
+                seen.update(ring)
+                rings.append(ring)
+        flat = Adjacency(rings)
+        self._setArrays(flat.indptr, flat.indices, radius)
+
+    @classmethod
+    def fromArrays(cls, indptr, indices, radius):
+        self = cls.__new__(cls)
+        self._setArrays(indptr, indices, radius)
+        return self
+
+    def _setArrays(self, indptr, indices, radius):
+        self.radius = radius
+        self.indptr = indptr
+        self.indices = indices
+        ringNumbers = numpy.tile(numpy.arange(radius + 1, dtype=numpy.int8),
+                                 (len(indptr) - 1) // (radius + 1))
+        self.hops = numpy.repeat(ringNumbers, numpy.diff(indptr))
+
+    def ring(self, edge, hop):
+        """Edges exactly 'hop' steps away from 'edge'."""
+        i = edge * (self.radius + 1) + hop
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def within(self, edge, hops=None):
+        """Edges at most 'hops' steps away (default: the whole radius), nearest first, and
+           the hop count of each, as two parallel arrays.
+           """
+        if hops is None:
+            hops = self.radius
+        start = self.indptr[edge * (self.radius + 1)]
+        end = self.indptr[edge * (self.radius + 1) + hops + 1]
+        return self.indices[start:end], self.hops[start:end]
+
 
 class Model(object):
     """A model of the physical sculpture. Holds information about the position and
@@ -13,17 +126,60 @@ class Model(object):
        
        The model is initialized using a JSON object which contains 3D positions for each vertex,
        and a list of graph edges which represent the lit segments between these vertices.
+
+       Everything we calculate from those files is saved to a binary cache next to the graph
+       file, keyed by a hash of both files, so later startups just load the arrays back.
+       The cache is rebuilt automatically when either file changes. Pass cache=False to
+       always calculate from scratch.
+
+       neighborhoodRadius sets how many hops out the precomputed neighborhoods go.
        """
 
-    def __init__(self, graph_filename, mapping_filename):
+    # Bump this whenever the set or meaning of the cached arrays changes.
+    cacheVersion = 3
+
+    # Attributes saved in the cache. Lists are stored as arrays, adjacency lists in CSR form.
+    _cachedArrays = ('edgeNodes', 'edgeHeight', 'rawNodes', 'minAABB', 'maxAABB', 'nodes',
+                     'edgeCenters', 'roots', 'edgeDistances', 'edgeTree', 'edgeHopDistances',
+                     'edgePathDistances', 'edgeRootHops', 'edgeGeodesicDistances')
+    _cachedAdjacency = ('edgeListForNodes', 'edgeAdjacency', 'outwardAdjacency',
+                        'inwardAdjacency')
+
+    def __init__(self, graph_filename, mapping_filename, cache=True, neighborhoodRadius=3):
+        self.graphFilename = graph_filename
+        self.neighborhoodRadius = neighborhoodRadius
+        graphText = open(graph_filename, 'rb').read()
+        mappingText = open(mapping_filename, 'rb').read()
+        self.cacheFilename = graph_filename + '.cache.npz'
+        self.cacheKey = hashlib.sha1('%d\0%d\0%s\0%s' % (
+            self.cacheVersion, neighborhoodRadius, graphText, mappingText)).hexdigest()
+
+        if not (cache and self._loadCache()):
+            self._calculate(json.loads(graphText), json.loads(mappingText))
+            if cache:
+                self._saveCache()
+
+        # Sparse edge adjacency matrix. adjacencyMatrix.dot(v) spreads a per-edge value to
+        # all neighboring edges in one step.
+        self.adjacencyMatrix = self.edgeAdjacencyCSR.matrix()
+
+    @property
+    def graphData(self):
+        # Raw graph data, only parsed if someone asks for it
+        if getattr(self, '_graphData', None) is None:
+            self._graphData = json.load(open(self.graphFilename))
+        return self._graphData
+
+    def _calculate(self, graphData, edgeForAddress):
         # Raw graph data
-        self.graphData = json.load(open(graph_filename))
+        self._graphData = graphData
 
         # Edges: Array of node ID 2-tuples. Indices of this array match LED indices.
         self.edges = map(tuple, self._strDictToArray(self.graphData['edges']))
+        self.edgeNodes = numpy.array(self.edges, dtype=numpy.int32)
 
         # Manual address data
-        self.edgeForAddress = json.load(open(mapping_filename))
+        self.edgeForAddress = edgeForAddress
         self.addressForEdge = {edge: address for address, edge in self.edgeForAddress.items()}
         self.edgeHeight = self._calculateEdgeHeights()
 
@@ -63,9 +219,107 @@ class Model(object):
         # Outward adjacency: Which edges are adjacent and at a greater edgeDistance?
         self.outwardAdjacency = self._calculateOutwardAdjacency()
 
+        # Inward adjacency: Which edges are adjacent and at a smaller edgeDistance?
+        self.inwardAdjacency = self._calculateInwardAdjacency()
+
+        # The same adjacency lists in CSR form (see Adjacency), for vectorized graph walks.
+        self.edgeListForNodesCSR = Adjacency(self.edgeListForNodes, self.numLEDs)
+        self.edgeAdjacencyCSR = Adjacency(self.edgeAdjacency)
+        self.outwardAdjacencyCSR = Adjacency(self.outwardAdjacency)
+        self.inwardAdjacencyCSR = Adjacency(self.inwardAdjacency)
+
+        # Neighborhoods: Each edge's neighbors grouped by hop distance, for ripple effects
+        self.neighborhoods = Neighborhoods(self.edgeAdjacencyCSR, self.neighborhoodRadius)
+
         # Which tree is each edge on?
         self.edgeTree = self._calculateEdgeTrees()
 
+        # Distances along the rods, as opposed to the straight-line edgeDistances:
+        #   edgeHopDistances[i, j] is the number of steps from edge i to edge j (-1 if they're
+        #   on different trees), and edgePathDistances[i, j] the length of the shortest path
+        #   between their centers (infinite if they're on different trees).
+        self.edgeHopDistances, self.edgePathDistances = self._calculateGraphDistances()
+
+        # Geodesic distance from the base: Steps from the nearest root, and the distance along
+        #   the branches from the bottom-center of the sculpture. This has the same units
+        #   as edgeDistances, and equals it at the roots, so it can be swapped in for it.
+        rootHops = self.edgeHopDistances[self.roots]
+        self.edgeRootHops = numpy.where(rootHops < 0, numpy.iinfo(rootHops.dtype).max,
+                                        rootHops).min(axis=0)
+        self.edgeGeodesicDistances = (self.edgePathDistances[self.roots] +
+            self.edgeDistances[self.roots].reshape(-1, 1)).min(axis=0)
+
+    def _saveCache(self):
+        arrays = dict((name, numpy.array(getattr(self, name))) for name in self._cachedArrays)
+        for name in self._cachedAdjacency:
+            csr = getattr(self, name + 'CSR')
+            arrays[name + '_indptr'] = csr.indptr
+            arrays[name + '_indices'] = csr.indices
+        arrays['neighborhoods_indptr'] = self.neighborhoods.indptr
+        arrays['neighborhoods_indices'] = self.neighborhoods.indices
+        addresses = sorted(self.edgeForAddress.items())
+        arrays['addresses'] = numpy.array([address for address, edge in addresses])
+        arrays['addressEdges'] = numpy.array([edge for address, edge in addresses])
+        arrays['cacheKey'] = numpy.array(self.cacheKey)
+
+        # Write to a temporary file and rename it into place, so a power cut can't leave a
+        # truncated cache behind.
+        tempFilename = '%s.%d.tmp' % (self.cacheFilename, os.getpid())
+        try:
+            with open(tempFilename, 'wb') as f:
+                numpy.savez(f, **arrays)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tempFilename, self.cacheFilename)
+        except (IOError, OSError) as err:
+            sys.stderr.write("Can't save model cache %s: %s\n" % (self.cacheFilename, err))
+
+    def _loadCache(self):
+        """Load all our arrays from the cache, if it's there and up to date. A cache we
+           can't read is deleted, so it gets rebuilt rather than failing every startup.
+           """
+        if not os.path.exists(self.cacheFilename):
+            return False
+        try:
+            return self._restoreCache()
+        except Exception as err:
+            sys.stderr.write("Discarding unreadable model cache %s: %s\n" % (
+                self.cacheFilename, err))
+            try:
+                os.remove(self.cacheFilename)
+            except OSError:
+                pass
+            return False
+
+    def _restoreCache(self):
+        with open(self.cacheFilename, 'rb') as f:
+            data = numpy.load(f)
+            arrays = dict((name, data[name]) for name in data.files)
+        if str(arrays.get('cacheKey')) != self.cacheKey:
+            return False
+
+        for name in self._cachedArrays:
+            setattr(self, name, arrays[name])
+        self.edges = map(tuple, self.edgeNodes.tolist())
+        self.numLEDs = len(self.edges)
+        self.rawNodes = map(tuple, self.rawNodes.tolist())
+        self.minAABB = self.minAABB.tolist()
+        self.maxAABB = self.maxAABB.tolist()
+        self.nodes = self.nodes.tolist()
+
+        self.edgeForAddress = dict(zip(arrays['addresses'].tolist(), arrays['addressEdges'].tolist()))
+        self.addressForEdge = {edge: address for address, edge in self.edgeForAddress.items()}
+
+        for name in self._cachedAdjacency:
+            csr = Adjacency.fromArrays(arrays[name + '_indptr'], arrays[name + '_indices'],
+                self.numLEDs)
+            setattr(self, name + 'CSR', csr)
+            setattr(self, name, numpy.array(csr.lists()))
+
+        self.neighborhoods = Neighborhoods.fromArrays(arrays['neighborhoods_indptr'],
+            arrays['neighborhoods_indices'], self.neighborhoodRadius)
+        return True
+
     def _calculateEdgeCenters(self):
         result = []
         for n1, n2 in self.edges:
@@ -114,6 +368,26 @@ class Model(object):
             result.append([ e for e in adj if self.edgeDistances[e] > dist ])
         return numpy.array(result)
 
+    def _calculateInwardAdjacency(self):
+        result = []
+        for edge, adj in enumerate(self.edgeAdjacency):
+            dist = self.edgeDistances[edge]
+            result.append([ e for e in adj if self.edgeDistances[e] < dist ])
+        return numpy.array(result)
+
+    def _calculateGraphDistances(self):
+        csr = self.edgeAdjacencyCSR
+        rows = numpy.repeat(numpy.arange(len(csr)), csr.degree)
+        steps = self.edgeCenters[csr.indices] - self.edgeCenters[rows]
+        weights = scipy.sparse.csr_matrix(
+            (numpy.sqrt((steps * steps).sum(axis=1)), csr.indices, csr.indptr),
+            shape=(len(csr), len(csr)))
+
+        hops = scipy.sparse.csgraph.shortest_path(csr.matrix(), unweighted=True)
+        hops[numpy.isinf(hops)] = -1
+        paths = scipy.sparse.csgraph.shortest_path(weights, method='D')
+        return hops.astype(numpy.int16), paths
+
     def _calculateEdgeHeights(self):
         result = [None] * len(self.edges)
         for mapping, edge in self.edgeForAddress.items():
@@ -140,6 +414,54 @@ class Model(object):
             result.append(d[key])
         return result
 
+    def edgesMatching(self, pattern):
+        """Sorted int32 array of the edges whose address matches a pattern like "*.*.2.1",
+           where '*' matches any one part. Results are cached, so after the first call this
+           is a dictionary lookup.
+           """
+        cache = self.__dict__.setdefault('_edgesMatchingCache', {})
+        edges = cache.get(pattern)
+        if edges is None:
+            edges = numpy.array(sorted(edge for address, edge in self.edgeForAddress.items()
+                                       if self.addressMatchesP(address, pattern)),
+                                dtype=numpy.int32)
+            edges.flags.writeable = False
+            cache[pattern] = edges
+        return edges
+
+    def addressMask(self, patterns):
+        """Boolean array over all edges, true where the edge's address matches any of the
+           patterns. Cached like edgesMatching().
+           """
+        patterns = tuple(patterns)
+        cache = self.__dict__.setdefault('_addressMaskCache', {})
+        mask = cache.get(patterns)
+        if mask is None:
+            mask = numpy.zeros(self.numLEDs, dtype=bool)
+            for pattern in patterns:
+                mask[self.edgesMatching(pattern)] = True
+            mask.flags.writeable = False
+            cache[patterns] = mask
+        return mask
+
+    def edgeGroups(self, depth):
+        """Group edges by the first 'depth' parts of their address: depth 1 groups by tree
+           (the same as edgeTree), depth 2 by the main branches of each tree, and so on.
+           Edges with shorter addresses than that are a group of their own. Returns an
+           int32 array with the group number of each edge, in address order. Cached.
+           """
+        cache = self.__dict__.setdefault('_edgeGroupsCache', {})
+        groups = cache.get(depth)
+        if groups is None:
+            prefixes = [None] * self.numLEDs
+            for address, edge in self.edgeForAddress.items():
+                prefixes[edge] = tuple(int(part) for part in address.split(".")[:depth])
+            numbers = dict((prefix, i) for i, prefix in enumerate(sorted(set(prefixes))))
+            groups = numpy.array([numbers[prefix] for prefix in prefixes], dtype=numpy.int32)
+            groups.flags.writeable = False
+            cache[depth] = groups
+        return groups
+
     def addressMatchesAnyP(self, address, patterns):
         for p in patterns:
           if self.addressMatchesP(address, p):
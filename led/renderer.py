@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
-import time
+import sys
 import numpy
-from effects.base import GammaLayer
+from effects.base import GammaLayer, RenderTimer, framePool, blend
+from clock import monotonic
 from playlist import Playlist
 
 
@@ -12,9 +13,11 @@ class Renderer:
     Performs smooth transitions when the active routine changes (either due to swapping 
     playlists or to advancing the selection in the current playlist).
     
-    Also applies a gamma correction layer after everything else is rendered.
+    Also applies a gamma correction layer after everything else is rendered, unless
+    'gamma' is None, for when gamma correction is done on output (see LUTEncoder).
     """
-    def __init__(self, playlists, activePlaylist=None, useFastFades=False, gamma=2.2):
+    def __init__(self, playlists, activePlaylist=None, useFastFades=False, gamma=2.2,
+                 adaptiveQuality=False, fadeOutgoingEvery=1):
         # playlists argument should be dictionary of playlist names : playlists.        
         if not playlists:
             raise Exception("Can't define a renderer without any playlists")
@@ -34,8 +37,17 @@ class Renderer:
         self.nextPlaylist = None 
         
         self.useFastFades = useFastFades
+        # How often the outgoing routine is re-rendered during fades; see LinearFade.
+        self.fadeOutgoingEvery = fadeOutgoingEvery
         self.fade = None
-        self.gammaLayer = GammaLayer(gamma)
+        self.compositor = Compositor()
+        self.gammaLayer = GammaLayer(gamma) if gamma else None
+
+        # Total render time per frame. Each layer keeps its own timer, see EffectLayer.
+        self.renderTimer = RenderTimer()
+
+        # With adaptiveQuality, expensive layers get cheaper when we can't keep up.
+        self.governor = QualityGovernor() if adaptiveQuality else None
         
     def _get(self, playlistKey):
         if playlistKey:
@@ -50,6 +62,7 @@ class Renderer:
         return self._get(self.nextPlaylist)
         
     def render(self, model, params, frame):
+        start = monotonic()
         if self.fade:
             self.fade.render(model, params, frame)
             if self.fade.done:
@@ -59,9 +72,69 @@ class Renderer:
                     self.nextPlaylist = None
                 self.fade = None
         elif self.activePlaylist:
-            for layer in self._active().selection():
-                layer.safely_render(model, params, frame)
-        self.gammaLayer.render(model, params, frame)
+            self.compositor.render(self._active().selection(), model, params, frame)
+        if self.gammaLayer:
+            self.gammaLayer.render(model, params, frame)
+        elapsed = monotonic() - start
+        self.renderTimer.record(elapsed)
+        if self.governor:
+            self.governor.update(self, elapsed, 1.0 / params.targetFrameRate)
+
+    def prepare(self, model):
+        """Let every layer in every playlist build its per-model tables now, rather than
+           on its first frame. See EffectLayer.prepare.
+           """
+        for playlist in self.playlists.values():
+            for routine in playlist.routines:
+                for layer in routine:
+                    layer.prepare(model)
+
+    def renderingRoutines(self):
+        """The layer lists being rendered right now: two during a fade, otherwise one."""
+        if self.fade:
+            return self.fade.renderingLayers()
+        elif self.activePlaylist:
+            return [self._active().selection()]
+        return []
+
+    def routineName(self, layers):
+        """Label a layer list by playlist name and routine index, like 'on[2]'."""
+        for name, playlist in self.playlists.items():
+            for i, routine in enumerate(playlist.routines):
+                if routine is layers:
+                    return '%s[%d]' % (name, i)
+        return '?'
+
+    def layerStats(self):
+        """Rolling render time statistics for every layer that is being rendered right now.
+           Returns a list of (routine name, layer, stats), see RenderTimer.stats().
+           """
+        result = []
+        for layers in self.renderingRoutines():
+            name = self.routineName(layers)
+            for layer in layers:
+                timer = getattr(layer, 'render_timer', None)
+                stats = timer.stats() if timer else None
+                if stats:
+                    result.append((name, layer, stats))
+        return result
+
+    def statsLine(self):
+        """One-line, key=value summary of render times in milliseconds (mean/max over the
+           last few hundred frames), for the periodic frame rate log.
+           """
+        fields = []
+        stats = self.renderTimer.stats()
+        if stats:
+            fields.append('render=%.2f/%.2f' % (stats['mean'], stats['max']))
+        if self.fade:
+            fields.append('fading=1')
+        if self.governor and self.governor.degraded:
+            fields.append('degraded=%d' % len(self.governor.degraded))
+        for name, layer, stats in self.layerStats():
+            fields.append('%s.%s=%.2f/%.2f' % (
+                name, type(layer).__name__, stats['mean'], stats['max']))
+        return ' '.join(fields)
         
     def advanceCurrentPlaylist(self, fadeTime=1):
         # Advance selection within current playlist
@@ -69,7 +142,8 @@ class Renderer:
         if active:
             selection = active.selection()
             active.advance()
-            self.fade = LinearFade(selection, active.selection(), fadeTime)
+            self.fade = LinearFade(selection, active.selection(), fadeTime, self.fadeOutgoingEvery,
+                self.compositor)
         else:
             raise Exception("Can't advance playlist - no playlist is currently active")
         
@@ -86,66 +160,212 @@ class Renderer:
         self.nextPlaylist = nextPlaylist
         
         if self.useFastFades:
-            self.fade = FastFade(active.selection(), self._next().selection(), fadeTime)
+            self.fade = FastFade(active.selection(), self._next().selection(), fadeTime,
+                self.fadeOutgoingEvery, self.compositor)
         else:
             if intermediatePlaylist:
                 middle = self._get(intermediatePlaylist)
-                self.fade = TwoStepLinearFade(active.selection(), middle.selection(), self._next().selection(), 0.25, self._fadeTimeForTransition(middle))
+                self.fade = TwoStepLinearFade(active.selection(), middle.selection(), self._next().selection(), 0.25, self._fadeTimeForTransition(middle),
+                    self.fadeOutgoingEvery, self.compositor)
                 if advanceAfterFadeOut:
                     middle.advance()
             else:
-                self.fade = LinearFade(active.selection(), self._next().selection(), fadeTime)
+                self.fade = LinearFade(active.selection(), self._next().selection(), fadeTime,
+                    self.fadeOutgoingEvery, self.compositor)
         if advanceAfterFadeOut:
             active.advance()
 
+class Compositor(object):
+    """
+    Renders a list of layers into a frame, combining each with the layers below it
+    according to its blendMode (see EffectLayer).
+
+    Layers without a blend mode, and additive layers in 'add' mode, draw straight into
+    the frame. Every other layer draws into a blank scratch frame from the frame pool,
+    which is then blended into the frame in place, in one or two passes. Nothing is
+    allocated per frame.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool or framePool
+
+    def render(self, layers, model, params, frame):
+        for layer in layers:
+            mode = layer.blendMode
+            if mode is None or (mode == 'add' and layer.additive):
+                layer.safely_render(model, params, frame)
+            else:
+                self.blend(layer, mode, model, params, frame)
+
+    def blend(self, layer, mode, model, params, frame):
+        scratch = self.pool.acquire(frame.shape, frame.dtype)
+        scratch.fill(0)
+        try:
+            layer.safely_render(model, params, scratch)
+            blend(frame, scratch, mode, self.pool)
+        finally:
+            self.pool.release(scratch)
+
+
+class QualityGovernor(object):
+    """
+    Keeps frames within budget by trading away quality. When the renderer runs over its
+    share of the frame period, the most expensive layer on screen that still has a cheaper
+    mode gets its quality lowered one step (see EffectLayer.set_quality). Once there's been
+    plenty of headroom for a while, quality is restored one step at a time.
+    """
+
+    # Each step renders additive layers one frame less often; see EffectLayer.set_quality
+    levels = (1.0, 0.5, 1.0 / 3, 0.25)
+    budget = 0.8            # Fraction of the frame period the renderer may use
+    headroom = 0.5          # Under this fraction of the budget, we can afford more quality
+    degradeAfter = 10       # Frames over budget (net of frames under) before lowering quality
+    restoreAfter = 200      # Frames in a row with headroom before raising quality
+
+    def __init__(self):
+        self.overBudget = 0
+        self.withHeadroom = 0
+        self.degraded = {}          # Layer -> index into levels
+        self.lowestLevel = {}       # Layer -> last level that actually made it cheaper
+
+    def update(self, renderer, renderTime, period):
+        budget = period * self.budget
+        if renderTime > budget:
+            self.overBudget += 1
+            self.withHeadroom = 0
+            if self.overBudget >= self.degradeAfter:
+                self.overBudget = 0
+                self._degrade(renderer)
+        else:
+            self.overBudget = max(0, self.overBudget - 1)
+            if self.degraded and renderTime < budget * self.headroom:
+                self.withHeadroom += 1
+                if self.withHeadroom >= self.restoreAfter:
+                    self.withHeadroom = 0
+                    self._restore(renderer)
+            else:
+                self.withHeadroom = 0
+
+    def _cost(self, layer):
+        timer = getattr(layer, 'render_timer', None)
+        if not timer or not timer.count:
+            return 0
+        return timer.recent().mean()
+
+    def _degrade(self, renderer):
+        candidates = []
+        for layers in renderer.renderingRoutines():
+            for layer in layers:
+                lowest = self.lowestLevel.get(layer, len(self.levels) - 1)
+                if self.degraded.get(layer, 0) < lowest:
+                    candidates.append((self._cost(layer), layer))
+        for cost, layer in sorted(candidates, reverse=True):
+            # Skip over levels which wouldn't make this layer any cheaper
+            current = self.degraded.get(layer, 0)
+            for level in range(current + 1, len(self.levels)):
+                if layer.set_quality(self.levels[level]) is not False:
+                    break
+            else:
+                self.lowestLevel[layer] = current
+                continue
+            self.degraded[layer] = level
+            sys.stderr.write("Over frame budget, lowered %s to quality %.2f\n" % (
+                type(layer).__name__, self.levels[level]))
+            return
+
+    def _restore(self, renderer):
+        cost, layer = min((self._cost(layer), layer) for layer in self.degraded)
+        level = self.degraded[layer] - 1
+        layer.set_quality(self.levels[level])
+        if level:
+            self.degraded[layer] = level
+        else:
+            del self.degraded[layer]
+        sys.stderr.write("Frame budget has headroom, raised %s to quality %.2f\n" % (
+            type(layer).__name__, self.levels[level]))
+
+
 class Fade:
     """
     Renders a smooth transition between multiple lists of effect layers
     """
-    def __init__(self, startLayers, endLayers):
+    def __init__(self, startLayers, endLayers, compositor=None):
         self.done = False # should be set to True when fade is complete
         self.startLayers = startLayers
         self.endLayers = endLayers # final layer list to be rendered after fade is done
+        self.compositor = compositor or Compositor()
     
     def render(self, model, params, frame):
         raise NotImplementedException("Implement in fader subclass")
+
+    def renderingLayers(self):
+        """The layer lists this fade is rendering at the moment."""
+        return [layers for layers in (self.startLayers, self.endLayers) if layers]
         
         
 class LinearFade(Fade):
     """
-    Renders a simple linear fade between two lists of effect layers
+    Renders a simple linear fade between two lists of effect layers.
+
+    The outgoing (start) layers render into a scratch frame from the frame pool, which is
+    kept for the whole fade and given back at the end. To keep transitions close to the
+    cost of a single routine, outgoingEvery=N only re-renders the outgoing layers every N
+    frames, holding their last frame in between, and outgoingEvery=None freezes them at
+    their first frame.
     """
-    def __init__(self, startLayers, endLayers, duration):
-        Fade.__init__(self, startLayers, endLayers)
+    def __init__(self, startLayers, endLayers, duration, outgoingEvery=1, compositor=None):
+        Fade.__init__(self, startLayers, endLayers, compositor)
         self.duration = float(duration)
+        self.outgoingEvery = outgoingEvery
         # set actual start time on first call to render
         self.start = None
+        self.scratch = None
+        self.frameCount = 0
         
     def render(self, model, params, frame):
         if not self.start:
-            self.start = time.time()
+            self.start = monotonic()
         # render the end layers
         if self.endLayers:
-            for layer in self.endLayers:
-                layer.safely_render(model, params, frame)
-        percentDone = (time.time() - self.start) / self.duration
+            self.compositor.render(self.endLayers, model, params, frame)
+        percentDone = (monotonic() - self.start) / self.duration
         if percentDone >= 1:
             self.done = True
+            self._releaseScratch()
         else:
             # if the fade is still in progress, render the start layers
             # and blend them in
-            numpy.multiply(frame, percentDone, frame)
             if self.startLayers:
-                frame2 = numpy.zeros(frame.shape)
-                for layer in self.startLayers:
-                    layer.safely_render(model, params, frame2) 
-                numpy.multiply(frame2, 1-percentDone, frame2)
-                numpy.add(frame, frame2, frame)
+                outgoing = self._renderOutgoing(model, params, frame)
+                # frame*p + outgoing*(1-p), computed in place as (frame - outgoing)*p + outgoing
+                numpy.subtract(frame, outgoing, frame)
+                numpy.multiply(frame, percentDone, frame)
+                numpy.add(frame, outgoing, frame)
+            else:
+                numpy.multiply(frame, percentDone, frame)
+
+    def _renderOutgoing(self, model, params, frame):
+        scratch = self.scratch
+        if scratch is None or scratch.shape != frame.shape or scratch.dtype != frame.dtype:
+            self._releaseScratch()
+            self.scratch = self.compositor.pool.acquire(frame.shape, frame.dtype)
+            self.frameCount = 0
+        every = self.outgoingEvery
+        if self.frameCount == 0 or (every and self.frameCount % every == 0):
+            self.scratch.fill(0)
+            self.compositor.render(self.startLayers, model, params, self.scratch)
+        self.frameCount += 1
+        return self.scratch
+
+    def _releaseScratch(self):
+        if self.scratch is not None:
+            self.compositor.pool.release(self.scratch)
+            self.scratch = None
             
             
 class TwoStepFade(Fade):
     def __init__(self, fade1, fade2, startLayers, endLayers):
-        Fade.__init__(self, startLayers, endLayers)
+        Fade.__init__(self, startLayers, endLayers, fade1.compositor)
         self.fade1 = fade1
         self.fade2 = fade2
     
@@ -155,6 +375,11 @@ class TwoStepFade(Fade):
         else:
             self.fade2.render(model, params, frame)
             self.done = self.fade2.done
+
+    def renderingLayers(self):
+        if not self.fade1.done:
+            return self.fade1.renderingLayers()
+        return self.fade2.renderingLayers()
             
             
 class FastFade(TwoStepFade):
@@ -163,9 +388,9 @@ class FastFade(TwoStepFade):
     more efficient than fading directly between two layer sets because we 
     never have to render both layer sets at the same time.
     """
-    def __init__(self, startLayers, endLayers, duration):
-        fade1 = LinearFade(startLayers, None, duration/2.)
-        fade2 = LinearFade(None, endLayers, duration/2.)
+    def __init__(self, startLayers, endLayers, duration, outgoingEvery=1, compositor=None):
+        fade1 = LinearFade(startLayers, None, duration/2., outgoingEvery, compositor)
+        fade2 = LinearFade(None, endLayers, duration/2., compositor=compositor)
         TwoStepFade.__init__(self, fade1, fade2, startLayers, endLayers)
 
             
@@ -174,9 +399,10 @@ class TwoStepLinearFade(TwoStepFade):
     Performs a linear fade to an intermediate effect layer list, then another linear
     fade to a final effect layer list. Useful for making something brief and dramatic happen.
     """
-    def __init__(self, currLayers, nextLayers, finalLayers, duration_1, duration_2):
-        fade1 = LinearFade(currLayers, nextLayers, duration_1)
-        fade2 = LinearFade(nextLayers, finalLayers, duration_2)
+    def __init__(self, currLayers, nextLayers, finalLayers, duration_1, duration_2, outgoingEvery=1,
+                 compositor=None):
+        fade1 = LinearFade(currLayers, nextLayers, duration_1, outgoingEvery, compositor)
+        fade2 = LinearFade(nextLayers, finalLayers, duration_2, outgoingEvery, compositor)
         TwoStepFade.__init__(self, fade1, fade2, currLayers, finalLayers)
         
 
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Receives the keyframes and deltas sent by a DeltaOPC over a slow link, rebuilds complete
+# frames and forwards them to an ordinary OPC server, such as a gl_server preview.
+#
+# Usage: ./preview_receiver.py [-l port] [-s opc-server]
+#
+# On the lights' end, add the preview to the controller's clients, for example:
+#   FanoutOPC([AsyncOPC('127.0.0.1:7890'), AsyncOPC(client=DeltaOPC('preview-host:7891'))])
+
+from __future__ import print_function
+import argparse
+import socket
+import struct
+import sys
+from led.controller import DeltaDecoder, FastOPC
+
+
+def receiveExactly(sock, size):
+    """Read exactly 'size' bytes from 'sock', or return None if the connection closes."""
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if not n:
+            return None
+        received += n
+    return data
+
+
+def receive(sock, opc):
+    """Rebuild and forward frames from one sender until it disconnects."""
+    decoder = DeltaDecoder()
+    frames = 0
+    while True:
+        header = receiveExactly(sock, 4)
+        if header is None:
+            return frames
+        channel, command, length = struct.unpack('>BBH', header)
+        payload = receiveExactly(sock, length)
+        if payload is None:
+            return frames
+        if command != 0xFF:
+            # Not a DeltaOPC message; pass it through as it is
+            opc.putMessage(header + payload)
+            continue
+        try:
+            updated = decoder.decode(payload)
+        except (ValueError, struct.error) as err:
+            # Our copy may be out of date now, so wait for the next keyframe
+            sys.stderr.write("Bad message from sender, waiting for a keyframe: %s\n" % err)
+            decoder.frame = None
+            continue
+        if updated:
+            opc.putMessage(decoder.frame)
+            frames += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild DeltaOPC frames for an OPC server")
+    parser.add_argument('-l', '--listen', type=int, default=7891, help="Port to listen on")
+    parser.add_argument('-s', '--server', help="OPC server to forward frames to "
+                        "(default: OPC_SERVER, or localhost)")
+    args = parser.parse_args()
+
+    opc = FastOPC(args.server)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', args.listen))
+    listener.listen(1)
+    sys.stderr.write("Listening for DeltaOPC on port %d, forwarding to %s\n" % (
+        args.listen, opc.server))
+
+    while True:
+        sock, address = listener.accept()
+        sys.stderr.write("Sender connected from %s:%d\n" % address)
+        try:
+            frames = receive(sock, opc)
+            sys.stderr.write("Sender disconnected after %d frames\n" % frames)
+        except socket.error as err:
+            sys.stderr.write("Lost sender: %s\n" % err)
+        finally:
+            sock.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,7 @@ import sys
 import time
 from led.model import Model
 from led.effects.base import EffectParameters
-from led.controller import AnimationController
+from led.controller import AnimationController, DitheringEncoder
 from led.renderer import Renderer
 from playlist import Playlist
 from flame.flameboard import FakeFlameBoard, I2CFlameBoard
@@ -49,8 +49,13 @@ if __name__ == '__main__':
         'off': playlists.headsetOff, 
         'transition': playlists.transition 
         }, 
-        activePlaylist='off')
-    controller = AnimationController(model, renderer=renderer, params=masterParams)
+        activePlaylist='off', adaptiveQuality=not test,
+        fadeOutgoingEvery=1 if test else 2, gamma=None)
+    # Gamma correction happens on output, fused with the conversion to 8 bits, which is
+    # dithered over time so dim colors don't band
+    controller = AnimationController(model, renderer=renderer, params=masterParams,
+                                     asyncSend=not test, dtype=None if test else 'auto',
+                                     encoder=DitheringEncoder(gamma=2.2))
     headset = FileHeadset() if test else BluetoothHeadset()
     flameBoard = FakeFlameBoard(solenoids) if test else I2CFlameBoard(solenoids)
     
@@ -2,15 +2,25 @@
 
 from distutils.core import setup, Extension
 import numpy
+import os
 
 #build using python setup.py build --build-platlib=.
+#
+#set CPLASMA_OPENMP=1 to build with OpenMP, so cplasma.fractal_noise() can use
+#several threads. Needs a compiler which understands -fopenmp.
+
+compileArgs = ['-Os', '-funroll-loops', '-ffast-math']
+linkArgs = []
+if os.environ.get('CPLASMA_OPENMP') == '1':
+    compileArgs.append('-fopenmp')
+    linkArgs.append('-fopenmp')
 
 setup(name="cplasma", version="1.0",
       ext_modules=[
           Extension("led/effects/cplasma", ["led/effects/cplasma/cplasma.c"],
-              extra_compile_args=['-Os', '-funroll-loops', '-ffast-math'],
+              extra_compile_args=compileArgs,
+              extra_link_args=linkArgs,
           ),
       ],
       include_dirs = [numpy.get_include()],
 )
-
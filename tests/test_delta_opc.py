@@ -0,0 +1,98 @@
+import unittest
+import numpy
+from led import controller
+from led.controller import DeltaOPC, DeltaDecoder
+
+
+class FakeConnection(object):
+    """Stands in for an OPCConnection, keeping what was sent. Sends fail while 'up' is False."""
+
+    def __init__(self, server):
+        self.server = server
+        self.up = True
+        self.messages = []
+
+    def connect(self):
+        return self.up
+
+    def send(self, data):
+        if not self.up:
+            return False
+        self.messages.append(bytes(data))
+        return True
+
+
+class DeltaOPCRoundTripTest(unittest.TestCase):
+
+    frameSize = 4 + 3 * 500
+
+    def setUp(self):
+        self.realConnection = controller.OPCConnection
+        controller.OPCConnection = FakeConnection
+        self.random = numpy.random.RandomState(1234)
+
+    def tearDown(self):
+        controller.OPCConnection = self.realConnection
+
+    def randomFrame(self):
+        return self.random.randint(0, 256, self.frameSize).astype(numpy.uint8)
+
+    def changeSome(self, frame, count=20):
+        frame = frame.copy()
+        frame[self.random.randint(0, len(frame), count)] = self.random.randint(0, 256, count)
+        return frame
+
+    def receive(self, client, decoder):
+        # Hand the decoder what follows the OPC header, as preview_receiver.py does
+        message = client.connection.messages[-1]
+        self.assertTrue(decoder.decode(message[4:]))
+        return ord(message[DeltaOPC.header.size - 1])
+
+    def test_deltas_reproduce_every_frame_exactly(self):
+        client = DeltaOPC('preview:7890', keyframeInterval=1e6, threshold=0)
+        decoder = DeltaDecoder()
+        frame = self.randomFrame()
+        kinds = []
+        for i in range(50):
+            self.assertTrue(client.putMessage(frame.tobytes()))
+            kinds.append(self.receive(client, decoder))
+            self.assertEqual(bytes(decoder.frame), frame.tobytes())
+            frame = self.changeSome(frame)
+        self.assertEqual(kinds, [DeltaOPC.KEYFRAME] + [DeltaOPC.DELTA] * 49)
+        self.assertLess(client.bytesSent, client.bytesFull)
+
+    def test_keyframes_reproduce_every_frame_exactly(self):
+        client = DeltaOPC('preview:7890', keyframeInterval=0, threshold=0)
+        decoder = DeltaDecoder()
+        for i in range(10):
+            frame = self.randomFrame()
+            self.assertTrue(client.putMessage(frame.tobytes()))
+            self.assertEqual(self.receive(client, decoder), DeltaOPC.KEYFRAME)
+            self.assertEqual(bytes(decoder.frame), frame.tobytes())
+
+    def test_dropped_delta_is_followed_by_a_keyframe(self):
+        client = DeltaOPC('preview:7890', keyframeInterval=1e6, threshold=0)
+        decoder = DeltaDecoder()
+        frame = self.randomFrame()
+        client.putMessage(frame.tobytes())
+        self.receive(client, decoder)
+
+        # This delta never reaches the receiver
+        frame = self.changeSome(frame)
+        client.connection.up = False
+        self.assertFalse(client.putMessage(frame.tobytes()))
+        client.connection.up = True
+
+        frame = self.changeSome(frame)
+        self.assertTrue(client.putMessage(frame.tobytes()))
+        self.assertEqual(self.receive(client, decoder), DeltaOPC.KEYFRAME)
+        self.assertEqual(bytes(decoder.frame), frame.tobytes())
+
+        frame = self.changeSome(frame)
+        client.putMessage(frame.tobytes())
+        self.assertEqual(self.receive(client, decoder), DeltaOPC.DELTA)
+        self.assertEqual(bytes(decoder.frame), frame.tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
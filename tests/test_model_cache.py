@@ -0,0 +1,77 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from led.model import Model
+
+modeling = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modeling')
+
+
+class CountingModel(Model):
+    """A Model which counts how often it had to calculate everything from scratch."""
+    calculations = 0
+
+    def _calculate(self, *args):
+        CountingModel.calculations += 1
+        Model._calculate(self, *args)
+
+
+class ModelCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.graph = os.path.join(self.directory, 'graph.data.json')
+        self.mapping = os.path.join(self.directory, 'manual.remap.json')
+        shutil.copy(os.path.join(modeling, 'graph.data.json'), self.graph)
+        shutil.copy(os.path.join(modeling, 'manual.remap.json'), self.mapping)
+        CountingModel.calculations = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        return CountingModel(self.graph, self.mapping)
+
+    def test_cache_is_reused_until_the_graph_changes(self):
+        first = self.load()
+        self.assertTrue(os.path.exists(first.cacheFilename))
+        self.load()
+        self.assertEqual(CountingModel.calculations, 1)
+
+        with open(self.graph) as f:
+            graph = json.load(f)
+        x, y, z = graph['nodes']['0']
+        graph['nodes']['0'] = [x, y, z - 1.0]
+        with open(self.graph, 'w') as f:
+            json.dump(graph, f)
+
+        changed = self.load()
+        self.assertEqual(CountingModel.calculations, 2)
+        self.assertNotEqual(changed.cacheKey, first.cacheKey)
+        self.assertAlmostEqual(changed.rawNodes[0][2], first.rawNodes[0][2] - 1.0)
+
+        # The rebuilt cache is the one used from now on
+        again = self.load()
+        self.assertEqual(CountingModel.calculations, 2)
+        self.assertEqual(list(again.rawNodes[0]), list(changed.rawNodes[0]))
+
+    def test_truncated_cache_is_removed_and_recalculated(self):
+        model = self.load()
+        with open(model.cacheFilename, 'rb') as f:
+            data = f.read()
+        with open(model.cacheFilename, 'wb') as f:
+            f.write(data[:len(data) // 2])
+
+        rebuilt = self.load()
+        self.assertEqual(CountingModel.calculations, 2)
+        self.assertEqual(rebuilt.numLEDs, model.numLEDs)
+        with open(model.cacheFilename, 'rb') as f:
+            self.assertEqual(len(f.read()), len(data))
+
+        self.load()
+        self.assertEqual(CountingModel.calculations, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
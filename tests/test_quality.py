@@ -0,0 +1,43 @@
+import unittest
+from led.effects.base import EffectLayer
+from led.effects.lightning_storm import LightningStormLayer
+from led.renderer import QualityGovernor
+
+
+class AdditiveLayer(EffectLayer):
+    additive = True
+
+
+class QualityLevelsTest(unittest.TestCase):
+
+    def test_every_level_changes_render_every(self):
+        layer = AdditiveLayer()
+        rates = []
+        for level in QualityGovernor.levels:
+            self.assertTrue(layer.set_quality(level))
+            rates.append(layer.render_every)
+        self.assertEqual(rates[0], 1)
+        for previous, current in zip(rates, rates[1:]):
+            self.assertGreater(current, previous)
+
+    def test_governor_never_takes_a_step_that_saves_nothing(self):
+        layer = LightningStormLayer()
+        routine = [layer]
+
+        class Renderer(object):
+            def renderingRoutines(self):
+                return [routine]
+
+        governor = QualityGovernor()
+        caps = []
+        for level in QualityGovernor.levels[1:]:
+            before = governor.degraded.get(layer, 0)
+            governor._degrade(Renderer())
+            if governor.degraded.get(layer, 0) != before:
+                caps.append(layer.maximum_bolts)
+        # Every step the governor reports has to actually lower the cap
+        for previous, current in zip(caps, caps[1:]):
+            self.assertLess(current, previous)
+
+if __name__ == '__main__':
+    unittest.main()